@@ -1,47 +1,124 @@
 #!/usr/bin/python3
+'''
+Graphical astronomical almanac.
+
+Run it as a script, or import it and use compute_almanac and render_almanac:
+
+    data = compute_almanac (Site (latitude='39.75', longitude='-105',
+            elevation=1582, tzoffset=-7), start='2024', end='2025')
+    render_almanac (data, 'almanac.pdf')
+
+Nothing is computed at import time, and matplotlib is only imported to render.
+'''
 import argparse
+import asyncio
+import calendar
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import csv
 import datetime
 import ephem
+import ephem.stars
+import hashlib
+import importlib.util
+import io
+import json
 import math
+import mmap
+import multiprocessing
+import numpy
+import os
+import signal
+import sqlite3
 import sys
 import time
-
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib.path import Path
+import tracemalloc
+import urllib.parse
 
 process_start_time_wall = time.perf_counter()
 process_start_time_cpu = time.process_time()
 
 Command = sys.argv[0]
 oneday = 1
-here = ephem.Observer ()
-
-# Determine which calendar year to use by default.
-default_year = ephem.localtime (ephem.now()).year
-if ephem.localtime (here.date).month >= 9:
-    default_year += 1
-
-parser = argparse.ArgumentParser (description='Generate a graphical astronomical ephemeris')
-parser.add_argument ('--latitude', '--lat', '-N', type=str, default='39.75',
-                   help='site latitude degrees north')
-parser.add_argument ('--longitude', '--lon', '-E', type=str, default='-105',
-                   help='site longitude degrees east')
-parser.add_argument ('--elevation', '--elev', '-L', type=float, default=1582,
-                   help='site elevation in meters')
-parser.add_argument ('--tzoffset', '--tz', '-Z', type=int, default=-7,
-                   help='the offset of the local timezone in hours after UTC')
-parser.add_argument ('--start-date', '--start', '-s', type=str, default=None,
-        help='start date for the chart. Date can be any string decoded by ephem.Date, e.g., -s 2018 or -s 2018-01. Default: now.')
-parser.add_argument ('--end-date', '--end', '-e', type=str, default=None,
-        help='end date for the chart. Default: one year after START_DATE.')
-parser.add_argument ('--output-file', '--output', '-o', type=str, default=None,
-        help='PDF output file. Default: displays chart in matplotlib\'s viewer.')
-parser.add_argument ('--verbose', '-v', action='count',
-                   help='verbose')
-args = parser.parse_args ()
-
-here.lon, here.lat, here.elev = args.longitude, args.latitude, args.elevation
+
+# Where the almanac is for. Angles are strings as for ephem.Observer,
+# elevation in meters, tzoffset in hours after UTC.
+Site = collections.namedtuple ("Site",
+        ["latitude", "longitude", "elevation", "tzoffset"],
+        defaults=['39.75', '-105', 1582, -7])
+
+def make_parser ():
+    '''Command line options.'''
+    parser = argparse.ArgumentParser (description='Generate a graphical astronomical ephemeris')
+    parser.add_argument ('--latitude', '--lat', '-N', type=str, default='39.75',
+                       help='site latitude degrees north')
+    parser.add_argument ('--longitude', '--lon', '-E', type=str, default='-105',
+                       help='site longitude degrees east')
+    parser.add_argument ('--elevation', '--elev', '-L', type=float, default=1582,
+                       help='site elevation in meters')
+    parser.add_argument ('--tzoffset', '--tz', '-Z', type=int, default=-7,
+                       help='the offset of the local timezone in hours after UTC')
+    parser.add_argument ('--start-date', '--start', '-s', type=str, default=None,
+            help='start date for the chart. Date can be any string decoded by ephem.Date, e.g., -s 2018 or -s 2018-01. Default: now.')
+    parser.add_argument ('--end-date', '--end', '-e', type=str, default=None,
+            help='end date for the chart. Default: one year after START_DATE.')
+    parser.add_argument ('--output-file', '--output', '-o', type=str, default=None,
+            help='PDF output file. Default: displays chart in matplotlib\'s viewer.')
+    parser.add_argument ('--engine', choices=['vector', 'pyephem', 'adaptive'], default=None,
+            help='how to compute event times: vector samples positions and finds all events with numpy arrays (fast); pyephem searches for each event on each day (slow); adaptive is pyephem searching every few days for slowly moving bodies and interpolating in between. Default: vector.')
+    parser.add_argument ('--precision', choices=list (precision_engines), default=None,
+            help='how precise event times need to be, instead of --engine: draft (within about ten minutes, for previews), print (within a minute, for charts) or exact (pyephem\'s own searches)')
+    parser.add_argument ('--precision-check', action='store_true',
+            help='print how far each precision tier is from exact, per body and event, and how long each takes, instead of drawing the chart')
+    parser.add_argument ('--adaptive-tolerance', type=float, default=adaptive_tolerance, metavar='SECONDS',
+            help='with --engine adaptive, search more often until interpolated times are within this many seconds. Default: %(default)s')
+    parser.add_argument ('--catalog', action='append', default=[], metavar='FILE',
+            help='also chart the transits of the bodies in FILE that transit at night: one per line, in XEphem database format (.edb files of asteroids, comets or your own targets) or the name of a pyephem star. "--catalog stars" is every pyephem star. May be repeated.')
+    parser.add_argument ('--max-magnitude', type=float, default=None, metavar='MAG',
+            help='leave out --catalog bodies fainter than this magnitude')
+    parser.add_argument ('--sun-horizon', action='append', default=[], metavar='NAME=DEGREES',
+            help='also plot when the sun crosses this altitude, e.g., --sun-horizon golden=6 or --sun-horizon official=-0:50. May be repeated. Computed in the same pass as sunrise and twilight.')
+    parser.add_argument ('--cache-dir', type=str,
+            default=os.path.join (os.environ.get ('XDG_CACHE_HOME',
+                os.path.expanduser ('~/.cache')), 'astroalmanac'),
+            help='directory for the persistent cache of computed event times. Default: %(default)s')
+    parser.add_argument ('--ephemeris', type=str, default=None, metavar='FILE',
+            help='look up the positions of the sun, moon and planets in FILE, written by --build-ephemeris, instead of computing them. Default: ephemeris.bin in CACHE_DIR, if there is one.')
+    parser.add_argument ('--build-ephemeris', action='store_true',
+            help='write the positions the vector engine uses for the sun, moon and planets, from START_DATE to END_DATE (default %s to %s), to the --ephemeris file, and exit' % ephemeris_span)
+    parser.add_argument ('--cache-size', type=float, default=64,
+            help='largest size of the event cache in megabytes; least recently used series are dropped beyond this. Default: %(default)s')
+    parser.add_argument ('--no-cache', action='store_true',
+            help='compute every event time afresh without reading or writing the cache')
+    parser.add_argument ('--raster-grid', type=int, default=None, metavar='DPI',
+            help='in PDF, SVG and PostScript charts, draw the dotted date and time grid as an image at DPI dots per inch, which saves faster but prints as a bitmap')
+    parser.add_argument ('--clear-cache', action='store_true',
+            help='empty the event cache before computing')
+    parser.add_argument ('--jobs', '-j', type=int, default=1,
+            help='number of worker processes computing event times with the pyephem searches, drawing pages, or drawing sites; no more than the number of CPUs. Default: 1, no workers.')
+    parser.add_argument ('--batch', type=str, default=None, metavar='SITES',
+            help='draw an almanac for every site in SITES, a CSV (with header row) or JSON list of sites with fields name, latitude, longitude, elevation, tzoffset, start_date, end_date, output_file, snapshot. Fields left out come from the other options. With --jobs, sites are drawn in parallel.')
+    parser.add_argument ('--pages', type=str, default=None, metavar='PAGES',
+            help='draw the chart as several pages from one computation: halves, quarters or months from START_DATE, or comma separated dates on which pages start. The pages go in one PDF (OUTPUT_FILE) unless --page-files.')
+    parser.add_argument ('--page-files', action='store_true',
+            help='with --pages, write each page to its own file, OUTPUT_FILE with -1, -2, ... before its extension')
+    parser.add_argument ('--serve', type=int, default=None, metavar='PORT',
+            help='run an HTTP server on localhost PORT that draws almanacs on request, e.g., http://localhost:PORT/almanac.pdf?latitude=51.5&longitude=0&tzoffset=0&start_date=2025. Formats are pdf, png and json. Parameters left out come from the other options. Drawing happens in --jobs worker processes.')
+    parser.add_argument ('--export', choices=['csv', 'jsonl', 'parquet'], default=None, metavar='FORMAT',
+            help='instead of drawing a chart, write every event (day, body, event, hours after noon, UTC time, whether the sun is up) as csv, jsonl (JSON Lines) or parquet (needs pyarrow) to OUTPUT_FILE, or standard output. Events are streamed a year at a time, so long date ranges need little memory.')
+    parser.add_argument ('--snapshot', type=str, default=None, metavar='FILE',
+            help='keep the computed event times in FILE. When FILE holds an earlier run for the same site, only the days it does not have are computed, e.g., for a rolling "next 12 months" almanac. With --batch, give each site its own snapshot field instead.')
+    parser.add_argument ('--profile', type=str, default=None, metavar='TRACE',
+            help='time each stage of the computation and drawing, and count the pyephem searches for each body, and write them to TRACE as JSON in Chrome trace format (open in chrome://tracing or ui.perfetto.dev). Work done in --jobs worker processes shows as a single span.')
+    parser.add_argument ('--profile-memory', action='store_true',
+            help='with --profile, also trace memory with tracemalloc: memory in use after each stage and the lines that allocated most')
+    parser.add_argument ('--profile-python', type=str, default=None, metavar='STATS',
+            help='run under cProfile and write its statistics to STATS, for python3 -m pstats STATS')
+    parser.add_argument ('--verbose', '-v', action='count',
+                       help='verbose')
+    return parser
 
 # Normalize date to noon localtime.
 def normalize_to_noon (t, tzoffset):
@@ -55,33 +132,28 @@ def normalize_to_noon (t, tzoffset):
     localnoon = (utc_time[0], utc_time[1], utc_time[2], 12 - tzoffset, 0, 0)
     return ephem.Date (localnoon)
 
-def determine_start_and_end_dates (args):
-    start_time = end_time = ephem.now()
-    if args.start_date == None:
+def chart_dates (start, end, tzoffset):
+    '''
+    Start and end of a chart as local noon ephem.Dates.
+    start and end are anything ephem.Date accepts, or None for now and
+    one year after start.
+    '''
+    if start == None:
         start_time = ephem.now()
     else:
-        start_time = ephem.Date(args.start_date)
-    start_time = normalize_to_noon (start_time, args.tzoffset)
-    if args.end_date == None:
+        start_time = ephem.Date(start)
+    start_time = normalize_to_noon (start_time, tzoffset)
+    if end == None:
         # Default end_time is one year after start_time.
         utc_time = start_time.tuple ()
         end_time = ephem.Date ((utc_time[0]+1, utc_time[1], utc_time[2], 0, 0, 0))
     else:
-        end_time = ephem.Date(args.end_date)
-    end_time = normalize_to_noon (end_time, args.tzoffset)
+        end_time = ephem.Date(end)
+    end_time = normalize_to_noon (end_time, tzoffset)
     return (start_time, end_time)
 
-start_date, end_date = determine_start_and_end_dates (args)
-
-print ("start date: %s" % (start_date,))
-print ("end date: %s" % (end_date,))
-
-days_in_chart = int (end_date - start_date + 0.5)
-mid_chart = int (days_in_chart / 2)  # only used for labelling
-
-if args.verbose:
-    print ("start %s, end %s, %s, %s  %3.0fm" % (start_date, end_date,
-        args.longitude, args.latitude, args.elevation))
+def determine_start_and_end_dates (args):
+    return chart_dates (args.start_date, args.end_date, args.tzoffset)
 
 # Color code different objects' text and curve.
 obcolor = {}
@@ -109,19 +181,20 @@ obfontsize["object"] = 4
 obfontsize["sun"]    = 3
 obfontsize["default"] = 4
 
+# Sun altitudes whose crossings are recorded in times, in order.
+# "sun" must come first; other objects are masked by it.
+# Horizons are strings, as for ephem.Observer.horizon.
+default_sun_horizons = {}
+default_sun_horizons["sun"]      = '0'
+default_sun_horizons["civil"]    = '-6'
+default_sun_horizons["nautical"] = '-12'
+default_sun_horizons["astro"]    = '-18'
+
 obwidth = {}
 obwidth["default"] = 1
 obwidth["sun"]    = 2
 
-if args.verbose:
-    print ("start_date = %s, end_date = %s" % (
-        ephem.Date(start_date), ephem.Date(end_date), ))
-
-here.date = start_date
-days = range (days_in_chart)
-times = {}
-
-def text_rotation (day, time, previous_day, previous_time):
+def text_rotation (day, time, previous_day, previous_time, days_in_chart):
     '''Day is the x-axis, time is the y-axis.
     Figure out how to rotate text to match the slope of the curve.
     Return rotation in degrees. '''
@@ -129,6 +202,9 @@ def text_rotation (day, time, previous_day, previous_time):
         return 0
     if day == None or time == None:
         return 0
+    if math.isnan (time) or math.isnan (previous_time):
+        # The sun does not rise or set that day, as inside the polar circle.
+        return 0
     slope = (time - previous_time) / (day - previous_day)
     # The slope here is odd - one hour in the y-axis is about the same size on
     # the plot as 17 days on the x-axis. So scale the slope accordingly.
@@ -141,77 +217,106 @@ def text_rotation (day, time, previous_day, previous_time):
     # print ("text rotation %3.2f deg, (%3.2f - %3.2f) / (%3.2f - %3.2f)" % ( degree, time, previous_time, day, previous_day))
     return degree
 
-def draw_time_lines (start_hour, end_hour, days, axes, times):
+def grid_polylines (x, y, shown):
+    '''
+    Lay out a grid of points for a single plot call: x and y broadcast
+    against the 2-D boolean array shown, hidden points become NaN, and a
+    NaN column is added so that rows do not join up.
+    Returns 2-D x and y, to be flattened row by row (or, transposed,
+    column by column).
+    '''
+    shape = (shown.shape[0] + 1, shown.shape[1] + 1)
+    gx = numpy.full (shape, math.nan)
+    gy = numpy.full (shape, math.nan)
+    gx[:-1, :-1] = x
+    gy[:-1, :-1] = numpy.where (shown, y, math.nan)
+    return (gx, gy)
+
+def time_grid (start_hour, end_hour, days, axes, times):
+    '''Dotted lines every half hour while the sun is down, one dot per
+    day, all in a single artist.'''
+    sun_rise = times["sun"]["rise"]
+    sun_set  = times["sun"]["set"]
+    y = numpy.arange (start_hour, end_hour + 1, 0.5)[:, numpy.newaxis]
+    x = numpy.arange (len (days))[numpy.newaxis, :]
+    dark = ~((y > sun_rise) | (y < sun_set))
+    x, y = grid_polylines (x, y, dark)
+    axes.plot (x.ravel (), y.ravel (),
+            color=obcolor['fullgrid'], linewidth=0.0,
+            marker='+', markerfacecolor=obcolor['fullgrid'], markersize=0.1)
+
+def draw_time_lines (start_hour, end_hour, days, axes, times, grid = True):
+    '''
+    Dotted lines every half hour while the sun is down (time_grid; left
+    out unless grid), plus hour labels and a solid midnight line.
+    '''
+    if grid:
+        time_grid (start_hour, end_hour, days, axes, times)
     for h in range (start_hour, end_hour+1):
-        # Full hour dotted line. One dot per day.
-        y = []
-        for d in days:
-            sun_rise = times["sun"]["rise"][d]
-            sun_set  = times["sun"]["set"][d]
-            y.append (math.nan if (h > sun_rise or h < sun_set) else h)
-        axes.plot (days, y,
-                color=obcolor['fullgrid'], linewidth=0.0,
-                marker='+', markerfacecolor=obcolor['fullgrid'], markersize=0.1)
         # Label the hours
         axes.text (0, h, "%02d" % ((h+12)%24,),
                 va="center", ha="right", rotation=90, fontsize=obfontsize['day'])
         axes.text (days[-1]+1, h, "%02d" % ((h+12)%24,),
                 va="center", ha="left", rotation=90, fontsize=obfontsize['day'])
-        # Half hour dotted line. One dot per day.
-        y = []
-        m = h + 0.5
-        for d in days:
-            sun_rise = times["sun"]["rise"][d]
-            sun_set  = times["sun"]["set"][d]
-            y.append (math.nan if (m > sun_rise or m < sun_set) else m)
-        axes.plot (days, y,
-                color=obcolor['fullgrid'], linewidth=0.0,
-                marker='+', markerfacecolor=obcolor['fullgrid'], markersize=0.1)
     # Solid line for midnight localtime (non-DST).
-    axes.plot (days, [12 for d in days], color='black', linewidth=0.5)
+    axes.plot ([0, days[-1]], [12, 12], color='black', linewidth=0.5)
     return
 
-def draw_date_lines (start_hour, end_hour, days, axes, times, start_date, where):
+def date_grid (start_hour, end_hour, days, axes, times):
+    '''Dotted lines every 7 days from sunset to sunrise, a dot every 5
+    minutes, all in a single artist.'''
+    weeks = numpy.arange (0, len (days), 7)
+    sun_rise = times["sun"]["rise"][weeks]
+    sun_set  = times["sun"]["set"][weeks]
+    # Fill in 5 minute intervals. 12 of those per hour.
+    y = numpy.arange (start_hour*12, end_hour*12)[:, numpy.newaxis] / 12.
+    dark = ~((y >= sun_rise) | (y <= sun_set))
+    x, y = grid_polylines (weeks[numpy.newaxis, :], y, dark)
+    axes.plot (x.T.ravel (), y.T.ravel (),
+            color=obcolor['fullgrid'], linewidth=0.01,
+            marker='+', markerfacecolor='red', markersize=0.1)
+
+def draw_date_lines (start_hour, end_hour, days, axes, times, start_date,
+        grid = True):
+    '''
+    Dotted lines every 7 days from sunset to sunrise (date_grid; left out
+    unless grid), labelled with the day of the month and, mid month, the
+    month. Weeks when the sun does not set (or rise) get no label there.
+    '''
+    weeks = numpy.arange (0, len (days), 7)
+    sun_rise = times["sun"]["rise"][weeks]
+    sun_set  = times["sun"]["set"][weeks]
+    if grid:
+        date_grid (start_hour, end_hour, days, axes, times)
     previous_d = None
     previous_sun_rise = None
     previous_sun_set = None
-    # Dots every 7 days
-    for d in days:
-        if (d % 7 != 0):
-            continue
-        sun_rise = times["sun"]["rise"][d]
-        sun_set  = times["sun"]["set"][d]
-        x = [d for i in range (12 * (end_hour-start_hour))]
-        y = []
-        # Fill in 5 minute intervals. 12 of those per hour.
-        for t in range (start_hour*12, end_hour*12):
-            h = t / 12. # back to hours
-            y.append (math.nan if (h >= sun_rise or h <= sun_set) else h)
-        axes.plot (x, y,
-                color=obcolor['fullgrid'], linewidth=0.01,
-                marker='+', markerfacecolor='red', markersize=0.1)
-        where.date = start_date
-        day = ephem.localtime (ephem.Date(here.date + d))
+    for d, sun_rise, sun_set in zip (weeks.tolist (), sun_rise.tolist (),
+            sun_set.tolist ()):
+        day = ephem.localtime (ephem.Date(start_date + d))
         # Label bottom sunset curve with day of month.
-        axes.text (d, sun_set, "%d " % (day.day,),
-                va="top", ha="center", rotation=90,
-                fontsize=obfontsize['day'])
+        if not math.isnan (sun_set):
+            axes.text (d, sun_set, "%d " % (day.day,),
+                    va="top", ha="center", rotation=90,
+                    fontsize=obfontsize['day'])
         if day.day >= 12 and day.day <= 18:
             # Label sunset and sunrise curves with month names.
-            axes.text (d, sun_set-3/6., day.strftime("%B"),
-                    va="top", ha="center",
-                    rotation=text_rotation(d,sun_set, previous_d, previous_sun_set),
-                    fontsize=obfontsize['month'])
-            axes.text (d, sun_rise+3/6., day.strftime("%B"),
-                    va="bottom", ha="center",
-                    rotation=text_rotation(d,sun_rise, previous_d, previous_sun_rise),
-                    fontsize=obfontsize['month'])
-        day = ephem.localtime (ephem.Date(here.date + d +end_hour*ephem.hour))
+            if not math.isnan (sun_set):
+                axes.text (d, sun_set-3/6., day.strftime("%B"),
+                        va="top", ha="center",
+                        rotation=text_rotation(d,sun_set, previous_d, previous_sun_set, len (days)),
+                        fontsize=obfontsize['month'])
+            if not math.isnan (sun_rise):
+                axes.text (d, sun_rise+3/6., day.strftime("%B"),
+                        va="bottom", ha="center",
+                        rotation=text_rotation(d,sun_rise, previous_d, previous_sun_rise, len (days)),
+                        fontsize=obfontsize['month'])
+        day = ephem.localtime (ephem.Date(start_date + d +end_hour*ephem.hour))
         # Label top sunrise curve with day of month.
-        axes.text (d, sun_rise, " %d" % (day.day,),
-                va="bottom", ha="center", rotation=90,
-                fontsize=obfontsize['day'])
-        #axes.text (days[-1], h, " %d" % ((h+12)%24,), va="center", ha="left")
+        if not math.isnan (sun_rise):
+            axes.text (d, sun_rise, " %d" % (day.day,),
+                    va="bottom", ha="center", rotation=90,
+                    fontsize=obfontsize['day'])
         previous_d = d
         previous_sun_rise = sun_rise
         previous_sun_set = sun_set
@@ -220,85 +325,1376 @@ def draw_date_lines (start_hour, end_hour, days, axes, times, start_date, where)
 def hours_after (t2, t1):
     return 24.0 * (t2-t1)
 
+# Observer method that searches for each event.
+event_search = {}
+event_search["set"]         = "next_setting"
+event_search["rise"]        = "next_rising"
+event_search["transit"]     = "next_transit"
+event_search["antitransit"] = "next_antitransit"
+
+# Whether the computation reports each stage as it finishes (--verbose).
+verbose = False
+
 def show_elapsed_time():
     print ("elapsed %3.2f total, %3.2f cpu" % (
         (time.perf_counter() - process_start_time_wall),
         (time.process_time() - process_start_time_cpu),
         ))
 
-def rise_set_transit (object, name, where, times, horizon = '0',
+# Instrumentation. tracing is the Trace being recorded, or None; while it is
+# None, span and count do nothing and cost next to nothing.
+tracing = None
+
+class Trace:
+    '''
+    Named, timed spans and counters, written out in Chrome's trace event
+    format (open it in chrome://tracing or https://ui.perfetto.dev).
+    With memory, tracemalloc runs, each span records the memory allocated
+    when it ends and how much it grew, and the trace lists the lines that
+    allocated the most.
+    '''
+    def __init__ (self, memory = False):
+        self.start = time.perf_counter ()
+        self.events = []
+        self.counts = {}
+        self.memory = memory
+        if memory:
+            tracemalloc.start ()
+
+    def now (self):
+        '''Microseconds since the trace started.'''
+        return (time.perf_counter () - self.start) * 1e6
+
+    @contextlib.contextmanager
+    def span (self, name, args):
+        if self.memory:
+            before = tracemalloc.get_traced_memory ()[0]
+        begin = self.now ()
+        try:
+            yield
+        finally:
+            end = self.now ()
+            if self.memory:
+                current = tracemalloc.get_traced_memory ()[0]
+                args = dict (args, memory=current, memory_delta=current - before)
+            self.events.append (dict (name=name, ph="X", ts=begin,
+                    dur=end - begin, pid=os.getpid (), tid=0, args=args))
+
+    def count (self, name, key, n):
+        '''Add n to counter name for key, and chart its new total.'''
+        counts = self.counts.setdefault (name, {})
+        counts[key] = counts.get (key, 0) + n
+        self.events.append (dict (name=name, ph="C", ts=self.now (),
+                pid=os.getpid (), tid=0, args={key: counts[key]}))
+
+    def write (self, path):
+        '''Save the trace as JSON in path, replacing it only once all of
+        it is written.'''
+        other = dict (command=sys.argv, counts=self.counts)
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory ()
+            other["memory_peak"] = peak
+            other["memory_top"] = [str (stat) for stat in
+                    tracemalloc.take_snapshot ().statistics ("lineno")[:20]]
+        def plain (value):
+            # Numbers from numpy arrays, which json does not know.
+            if isinstance (value, numpy.generic):
+                return value.item ()
+            raise TypeError ("%s in a trace" % (type (value).__name__,))
+        with open (path + ".new", "w") as f:
+            json.dump (dict (traceEvents=self.events, displayTimeUnit="ms",
+                    otherData=other), f, default=plain)
+        os.replace (path + ".new", path)
+
+class NoSpan:
+    '''What span returns when nothing is being traced.'''
+    def __enter__ (self):
+        return self
+    def __exit__ (self, *exc):
+        return False
+
+no_span = NoSpan ()
+
+def span (name, **args):
+    '''Context manager timing a named stage when tracing.'''
+    if tracing == None:
+        return no_span
+    return tracing.span (name, args)
+
+def count (name, key, n = 1):
+    '''Add n to counter name for key (e.g., a body) when tracing.'''
+    if tracing != None:
+        tracing.count (name, key, n)
+
+# Warm started searches: from the fourth day on, each day's event is found
+# from the days before, extrapolating the drift of the last three, with a
+# few steps of the Newton's method pyephem's own searches use, and only
+# searched for afresh when that does not land within track_bracket days of
+# the guess, as the first event of the day.
+track_events = True
+track_iterations = 3
+track_bracket = 1.0 / 24
+# Searches that carry anything from one day to the next start afresh every
+# search_block days, counted from absolute day numbers, and a range of days
+# is searched from the start of its first block. So each day comes out the
+# same whatever range it is computed in, as with the vector engine.
+search_block = 64
+
+def search_lead (first):
+    '''Days from the start of the search block to ephem.Date float first.'''
+    return int (math.floor (first)) % search_block
+
+def track_event (observer, object, event, guess, period, pressure):
+    '''
+    The date of object's event (a key of event_search) near the ephem.Date
+    float guess, the events being about period days apart, found as pyephem
+    finds it: by Newton's method on the hour angle, to within
+    ephem.default_newton_precision.
+    observer's pressure must be zero, as it is during pyephem's rise and
+    set searches; pressure is the pressure refraction is undone for.
+    Returns the date, or None if there is no such event or it takes more
+    than track_iterations steps.
+    '''
+    t = guess
+    for _ in range (track_iterations):
+        observer.date = t
+        object.compute (observer)
+        if event == "transit":
+            target, ha = 0.0, observer.sidereal_time () - object.g_ra
+        elif event == "antitransit":
+            target, ha = math.pi, observer.sidereal_time () - object.g_ra
+        else:
+            horizon = observer.horizon - object.radius
+            if pressure:
+                horizon = ephem.unrefract (pressure, observer.temp, horizon)
+            arg = ((math.sin (horizon) - math.sin (observer.lat) * math.sin (object.dec))
+                    / (math.cos (observer.lat) * math.cos (object.dec)))
+            if abs (arg) > 1:
+                return None
+            target, ha = math.acos (arg), object.ha
+            if event == "rise":
+                target = -target
+        bump = ((target - ha - math.pi) % (2 * math.pi) - math.pi) / (2 * math.pi) * period
+        if abs (bump) < ephem.default_newton_precision:
+            return t
+        t += bump
+    return None
+
+def event_hours_search (object, where, first, day_count, horizons,
+        do_rise = True, do_set = True, do_transit = True,
+        do_anti_transit = False, tolerance = None, warm = None):
+    '''
+    Same as event_hours, but with one pyephem search per event per day.
+    Slow, but what pyephem reports (warm started, see track_event, unless
+    warm is False).
+    With tolerance (seconds), slowly moving bodies are only searched every
+    few days and the times in between interpolated (see adaptive_hours).
+    '''
+    if warm == None:
+        warm = track_events
+    spacing = int (adaptive_spacing_knots * choose_knot_step (object))
+    # Bodies that would get a shorter spacing are searched every day.
+    adaptive = tolerance != None and spacing >= adaptive_min_spacing
+    # Search from the start of the first search_block, as a range starting
+    # there would, and keep only the days asked for. Adaptive searching
+    # goes on to the end of the last block, and the first day of the next,
+    # where its last interval ends.
+    lead = search_lead (float (first)) if warm or adaptive else 0
+    keep = slice (lead, lead + day_count)
+    first = float (first) - lead
+    if adaptive:
+        day_count = (int (math.ceil ((lead + day_count) / search_block))
+                * search_block + 1)
+    else:
+        day_count += lead
+    observer = where.copy ()
+    tracker = where.copy ()
+    tracker.pressure = 0
+    starts = float (first) + numpy.arange (day_count) * oneday
+    if do_rise or do_set:
+        track = sample_positions (object, where, float (first),
+                float (first) + day_count + 1, choose_knot_step (object))
+    timed = tracing != None
+    searches = list (event_search.values ()) + ["track_event"]
+    calls = dict.fromkeys (searches, 0)
+    seconds = dict.fromkeys (searches, 0.0)
+    # Event -> the last three (day, date) found, by day.
+    found = {}
+
+    def track_day (event, i):
+        '''The date of the event on day i, tracked from the last three days
+        found, or None.'''
+        (i0, t0), (i1, t1), (i2, t2) = found[event]
+        period = (t2 - t1) / (i2 - i1)
+        # The parabola through the three.
+        guess = (t0 * (i - i1) * (i - i2) / ((i0 - i1) * (i0 - i2))
+                + t1 * (i - i0) * (i - i2) / ((i1 - i0) * (i1 - i2))
+                + t2 * (i - i0) * (i - i1) / ((i2 - i0) * (i2 - i1)))
+        if timed:
+            begin = time.perf_counter ()
+        when = track_event (tracker, object, event, guess, period,
+                observer.pressure)
+        if timed:
+            seconds["track_event"] += time.perf_counter () - begin
+            calls["track_event"] += 1
+        # It must also be the day's first event, not the one after.
+        if (when == None or abs (when - guess) > track_bracket
+                or not starts[i] <= when < starts[i] + oneday
+                or when - period >= starts[i]):
+            count ("track_misses", object.name, 1)
+            return None
+        return when
+
+    def search_day (event, i):
+        '''Hours after the start of day i to the next event, or NaN.'''
+        # No rising or setting to find on a day the body is up, or down,
+        # throughout.
+        if event in ("rise", "set") and classes[i] != NORMAL:
+            found[event] = []
+            return math.nan
+        if found[event] and found[event][-1][0] // search_block != i // search_block:
+            found[event] = []
+        if warm and len (found[event]) == 3 and found[event][2][0] < i:
+            when = track_day (event, i)
+            if when != None:
+                found[event] = found[event][1:] + [(i, when)]
+                return hours_after (when, starts[i])
+        observer.date = starts[i]
+        search = getattr (observer, event_search[event])
+        try:
+            if timed:
+                begin = time.perf_counter ()
+                when = search (object)
+                seconds[event_search[event]] += time.perf_counter () - begin
+                calls[event_search[event]] += 1
+            else:
+                when = search (object)
+        except ephem.CircumpolarError:
+            # The search ran on into days when the body does not cross
+            # the horizon, so there is none within a day.
+            found[event] = []
+            return math.nan
+        h = hours_after (when, observer.date)
+        if h > 24 :
+            found[event] = []
+            return math.nan
+        found[event] = (found[event] + [(i, float (when))])[-3:]
+        return h
+
+    def search_days (event):
+        found[event] = []
+        if adaptive:
+            # Each block on its own, from a fresh start, so that its knots
+            # fall on the same days, and are searched the same way,
+            # whatever the range. The day ending one block starts the next.
+            searchable = classes == NORMAL if event in ("rise", "set") else None
+            hours = numpy.full (day_count, math.nan)
+            for b in range (0, day_count - 1, search_block):
+                found[event] = []
+                days = slice (b, b + search_block + 1)
+                hours[days] = adaptive_hours (
+                        lambda i: search_day (event, b + i), starts[days],
+                        spacing, tolerance,
+                        None if searchable is None else searchable[days])
+            return hours
+        return numpy.array ([search_day (event, i) for i in range (day_count)])
+
+    classes = None
+    shared = {}
+    observer.horizon = tracker.horizon = horizons[0]
+    if do_transit: shared["transit"] = search_days ("transit")
+    if do_anti_transit: shared["antitransit"] = search_days ("antitransit")
+    result = {}
+    for horizon in horizons:
+        observer.horizon = tracker.horizon = horizon
+        hours = dict (shared)
+        if do_rise or do_set:
+            classes = day_classes (track, where, float (first), day_count,
+                    horizon)
+            count ("circumpolar_days", object.name,
+                    int (numpy.count_nonzero (classes != NORMAL)))
+        if do_set: hours["set"] = search_days ("set")
+        if do_rise: hours["rise"] = search_days ("rise")
+        result[horizon] = hours
+    if timed:
+        # One span per kind of search, as if they had run back to back.
+        end = tracing.now ()
+        for name in calls:
+            if calls[name]:
+                tracing.events.append (dict (name=name, ph="X",
+                        ts=end - seconds[name] * 1e6, dur=seconds[name] * 1e6,
+                        pid=os.getpid (), tid=1, args=dict (body=object.name,
+                            calls=calls[name])))
+                count (name, object.name, calls[name])
+    return {horizon: {event: hours[keep] for event, hours in events.items ()}
+            for horizon, events in result.items ()}
+
+# Adaptive searching, for the adaptive engine: search every
+# adaptive_spacing_knots knot steps of the body (see knot_step) and
+# interpolate, refining until within adaptive_tolerance seconds.
+adaptive_spacing_knots = 4
+adaptive_tolerance = 10.0
+# Bodies that would get a shorter spacing (the moon and Mercury) change too
+# quickly to gain from it, and are searched every day.
+adaptive_min_spacing = 8
+
+def interpolate_events (starts, knots, hours):
+    '''
+    Interpolate the hours of the next event after each day in starts
+    (ephem.Date floats, one a day) from hours already known on the days in
+    knots (a sorted list).
+    The times of successive events are a smooth function of their count,
+    so each event between two knots is interpolated by a cubic through
+    the nearest knots, numbering events by their spacing, and each day
+    then takes the first event after its start. This handles the days on
+    which the event passes the start of the day.
+    Days between two knots where either has no event, or where the number
+    of events between them is unclear, come out NaN.
+    Returns a numpy array of hours.
+    '''
+    knots = numpy.array (knots)
+    h = hours[knots]
+    events = starts[knots] + h / 24
+    gaps = numpy.diff (events)
+    ok = ~numpy.isnan (gaps)
+    # Mean time between events, which is near a day for everything but
+    # the moon.
+    period = 1.0
+    if ok.any () and numpy.rint (gaps[ok]).sum () > 0:
+        period = gaps[ok].sum () / numpy.rint (gaps[ok] / period).sum ()
+    steps = gaps / period
+    ok &= abs (steps - numpy.rint (steps)) < 0.25
+    # Event numbers, counting on from the previous knot.
+    numbers = numpy.concatenate (([0], numpy.cumsum (numpy.where (ok,
+            numpy.rint (steps), 0))))
+    result = numpy.full (len (starts), math.nan)
+    result[knots] = h
+    for j in numpy.nonzero (ok)[0]:
+        # And the knots either side, where the events between are counted.
+        low = j
+        while low > j - 1 and low > 0 and ok[low - 1]:
+            low -= 1
+        high = j + 1
+        while high < j + 2 and high < len (ok) and ok[high]:
+            high += 1
+        n = numbers[low:high+1] - numbers[j]
+        fit = numpy.polyfit (n, events[low:high+1] - events[j],
+                len (n) - 1)
+        between = events[j] + numpy.polyval (fit,
+                numpy.arange (0, numbers[j+1] - numbers[j] + 1))
+        days = slice (knots[j] + 1, knots[j+1])
+        result[days] = next_events (between, starts[days])
+    return result
+
+def adaptive_hours (search, starts, spacing, tolerance, searchable = None):
+    '''
+    The same hours as [search (i) for i in range (len (starts))], where
+    search (i) finds the next event after starts[i] (one a day), but
+    searching only every spacing days and interpolating in between with
+    interpolate_events.
+    Each interval between searches is checked by a search at its middle
+    and halved until that is within tolerance seconds of the
+    interpolation. Intervals with days that are not searchable (a boolean
+    array, e.g., from day_classes) are searched every day.
+    '''
+    day_count = len (starts)
+    hours = numpy.full (day_count, math.nan)
+    known = numpy.zeros (day_count, dtype=bool)
+    if searchable is None:
+        searchable = numpy.ones (day_count, dtype=bool)
+    knots = sorted (set (range (0, day_count, spacing)) | {day_count - 1})
+    unchecked = list (zip (knots[:-1], knots[1:]))
+    while True:
+        for i in knots:
+            if not known[i]:
+                hours[i] = search (i)
+                known[i] = True
+        if not unchecked:
+            break
+        guess = interpolate_events (starts, knots, hours)
+        halves = []
+        for a, b in unchecked:
+            if b - a < 2:
+                continue
+            middle = (a + b) // 2
+            knots.append (middle)
+            if searchable[a:b+1].all ():
+                hours[middle] = search (middle)
+                known[middle] = True
+                if abs (hours[middle] - guess[middle]) * 3600 <= tolerance:
+                    continue
+            halves += [(a, middle), (middle, b)]
+        knots.sort ()
+        unchecked = halves
+    return interpolate_events (starts, knots, hours)
+
+# Vectorized event engine.
+# Rather than asking pyephem for each event on each day, sample each body's
+# apparent geocentric position at a few knots per day, interpolate those
+# onto a dense time grid, and find the horizon and meridian crossings with
+# array arithmetic. This reproduces pyephem's own rise/set geometry (see
+# Observer._find_rise_or_set): topocentric hour angle and declination with
+# no refraction, against a horizon lowered by the body's radius and
+# unrefracted for the observer's pressure. Transits use the geocentric
+# hour angle, as in Observer._compute_transit.
+
+sidereal_rate = 2 * math.pi * 1.002737909350795   # radians per day
+grid_step = 1.0 / 24    # dense grid spacing in days (one hour)
+refine_tolerance = 0.01 # seconds to refine each crossing to
+refine_max_iterations = 30  # Illinois steps before giving up on one
+turn_iterations = 3     # parabola steps to a peak or dip
+
+# Rows of the sampled track. LST has the steady sidereal rotation removed.
+LST, RA, DEC, PARALLAX = range (4)
+
+# Days between position samples. Moving bodies need closer knots.
+knot_step = {}
+knot_step["moon"]    = 0.5
+knot_step["sun"]     = 2.0
+knot_step["Mercury"] = 1.0
+knot_step["Venus"]   = 2.0
+knot_step["Mars"]    = 2.0
+knot_step["Jupiter"] = 4.0
+knot_step["Saturn"]  = 4.0
+knot_step["Uranus"]  = 8.0
+knot_step["Neptune"] = 8.0
+knot_step["star"]    = 16.0
+knot_step["default"] = 2.0
+
+def choose_knot_step (object):
+    '''Days between position samples for object.'''
+    if isinstance (object, ephem.FixedBody):
+        return knot_step["star"]
+    if isinstance (object, ephem.Moon):
+        return knot_step["moon"]
+    if isinstance (object, ephem.Sun):
+        return knot_step["sun"]
+    return knot_step.get (object.name, knot_step["default"])
+
+# Site independent knots from geocentric_samples, by body and knot step.
+position_memo = {}
+# The EphemerisTable geocentric_samples looks knots up in first, or None.
+ephemeris_table = None
+
+def geocentric_knot (object, greenwich, t):
+    '''
+    Greenwich apparent sidereal time and object's apparent geocentric RA,
+    declination, horizontal parallax and radius at t (days), using
+    greenwich, an ephem.Observer.
+    '''
+    greenwich.date = t
+    # Geocentric: computing for an observer would make earth_distance
+    # topocentric.
+    object.compute (greenwich.date)
+    # Fixed stars have no distance; give them no parallax.
+    return (greenwich.sidereal_time (), object.g_ra, object.g_dec,
+            0.0 if isinstance (object, ephem.FixedBody) else
+                ephem.earth_radius / (object.earth_distance * ephem.meters_per_au),
+            object.radius)
+
+def geocentric_samples (object, k0, k1, step):
+    '''
+    geocentric_knot at knots k0 through k1 (ephem.Date k * step). None of
+    these depend on the site, so knots are remembered and reused by other
+    sites and overlapping date ranges, or looked up in ephemeris_table.
+    Returns a 2-D numpy array with those five rows.
+    '''
+    if ephemeris_table != None:
+        rows = ephemeris_table.knots (object, step, k0, k1)
+        if rows is not None:
+            return rows.T
+    memo = position_memo.setdefault ((body_spec (object), step), {})
+    greenwich = ephem.Observer ()
+    for k in range (k0, k1 + 1):
+        if k not in memo:
+            memo[k] = geocentric_knot (object, greenwich, k * step)
+    return numpy.array ([memo[k] for k in range (k0, k1 + 1)]).T
+
+# Bodies write_ephemeris_table tabulates.
+ephemeris_bodies = ["Sun", "Moon", "Mercury", "Venus", "Mars", "Jupiter",
+        "Saturn", "Uranus", "Neptune"]
+# Dates --build-ephemeris covers unless given others.
+ephemeris_span = ('2000', '2050')
+
+def write_ephemeris_table (f, first, last):
+    '''
+    Write to the binary file f every knot geocentric_samples would need
+    for ephemeris_bodies from ephem.Date first to last, for
+    EphemerisTable: a one line JSON header padded to a whole page, then
+    each body's knots as a (knots, 5) float64 array.
+    '''
+    bodies = []
+    tables = []
+    greenwich = ephem.Observer ()
+    for name in ephemeris_bodies:
+        object = getattr (ephem, name) ()
+        step = choose_knot_step (object)
+        # The same margins as sample_positions.
+        k0 = int (math.floor (float (first) / step)) - 1
+        k1 = int (math.ceil (float (last) / step)) + 2
+        tables.append (numpy.array ([geocentric_knot (object, greenwich, k * step)
+                for k in range (k0, k1 + 1)], dtype='<f8'))
+        bodies.append ([body_spec (object), step, k0, k1 - k0 + 1])
+    header = json.dumps (dict (ephem=ephem.__version__, dtype='<f8',
+            bodies=bodies)).encode ()
+    # Pages of data start on a page of the file, so they map directly.
+    f.write (header + b" " * (-(len (header) + 1) % mmap.PAGESIZE) + b"\n")
+    for table in tables:
+        f.write (table.data)
+
+class EphemerisTable:
+    '''
+    Knots written by write_ephemeris_table, memory-mapped from the file at
+    path: nothing is read until a body's knots are used, and processes
+    using the same file share its pages.
+    '''
+    def __init__ (self, path):
+        with open (path, "rb") as f:
+            header = json.loads (f.readline ())
+            offset = f.tell ()
+        self.ephem = header["ephem"]
+        count = sum (body[3] for body in header["bodies"])
+        data = numpy.memmap (path, dtype=header["dtype"], mode='r',
+                offset=offset, shape=(count, 5))
+        # (body spec, step) -> (first knot, its rows)
+        self.tables = {}
+        for spec, step, k0, n in header["bodies"]:
+            self.tables[(tuple (spec), step)] = (k0, numpy.asarray (data[:n]))
+            data = data[n:]
+
+    def knots (self, object, step, k0, k1):
+        '''The rows of object's knots k0 through k1 (as in
+        geocentric_samples), or None if the table does not have them.
+        The coarser steps of the precision tiers take every few rows.'''
+        spec = body_spec (object)
+        for scale in sorted (set (s for s, _, _ in vector_settings.values ())):
+            table = self.tables.get ((spec, step / scale))
+            if table != None:
+                break
+        else:
+            return None
+        first, rows = table
+        k0 *= scale
+        k1 *= scale
+        if k0 < first or k1 - first >= len (rows):
+            return None
+        return rows[k0 - first:k1 - first + 1:scale]
+
+def forget_positions (before):
+    '''
+    Drop remembered knots more than a few days before the ephem.Date
+    before, so that walking through a long date range keeps memory flat.
+    '''
+    for (spec, step), memo in position_memo.items ():
+        oldest = int (math.floor (before / step)) - 2
+        for k in [k for k in memo if k < oldest]:
+            del memo[k]
+
+def sample_positions (object, where, first, last, step):
+    '''
+    Sample object's apparent geocentric position every step days,
+    with enough knots before first and after last (ephem.Date) for cubic
+    interpolation anywhere in between.
+    Returns a dict holding the knot times and a 2-D numpy array of
+    LST, RA, DEC and PARALLAX rows, angles in radians, plus the body's
+    radius at each knot, and the four knot windows used by interpolate.
+    Every knot's values depend only on its time, never on first or last,
+    so that a day comes out the same whatever range it is computed in.
+    '''
+    # Knots sit on multiples of step so that they can be shared.
+    k0 = int (math.floor (first / step)) - 1
+    k1 = int (math.ceil (last / step)) + 2
+    rows = geocentric_samples (object, k0, k1, step)
+    times = step * numpy.arange (k0, k1 + 1)
+    values = numpy.empty ((4, k1 - k0 + 1))
+    # Angles are left wrapped; the windows below unwrap them.
+    values[LST] = numpy.remainder (rows[0] + float (where.lon)
+            - sidereal_rate * times, 2 * math.pi)
+    values[RA] = rows[1]
+    values[DEC] = rows[2]
+    values[PARALLAX] = rows[3]
+    # windows[j][:, k] is knot k + j, with the angles unwrapped from knot k.
+    n = values.shape[1] - 3
+    windows = numpy.stack ([values[:, j:n+j] for j in range (4)])
+    for j in (1, 2, 3):
+        for row in (LST, RA):
+            windows[j, row] = windows[0, row] + numpy.remainder (
+                    windows[j, row] - windows[0, row] + math.pi,
+                    2 * math.pi) - math.pi
+    return {
+        "k0": k0,
+        "windows": windows,
+        "step": step,
+        "times": times,
+        "values": values,
+        "radius": rows[4],
+    }
+
+def interpolate (track, t):
+    '''
+    Four point Lagrange interpolation of every row of track["values"] at
+    times t (days, numpy array). The LST and RA rows are unwrapped from the
+    first of the four knots, so they may come out a whole turn apart from
+    one interval to the next.
+    '''
+    windows = track["windows"]
+    # Measured from knot zero, so the same t always gives the same weights.
+    u = t / track["step"] - track["k0"]
+    k = numpy.clip (numpy.floor (u).astype (int) - 1, 0, windows.shape[2] - 1)
+    u = u - k - 1   # position relative to the second of the four knots
+    w0 = -u * (u - 1) * (u - 2) / 6
+    w1 = (u + 1) * (u - 1) * (u - 2) / 2
+    w2 = -(u + 1) * u * (u - 2) / 2
+    w3 = (u + 1) * u * (u - 1) / 6
+    return (w0 * windows[0][:, k] + w1 * windows[1][:, k]
+            + w2 * windows[2][:, k] + w3 * windows[3][:, k])
+
+def observer_geocentric (where):
+    '''
+    Observer's latitude, and distance from the equatorial plane and from
+    the earth's axis in earth radii, using the same oblate earth as libastro.
+    '''
+    lat = float (where.lat)
+    height = where.elevation / ephem.earth_radius
+    u = math.atan (0.996647 * math.tan (lat))
+    rho_sin = 0.996647 * math.sin (u) + height * math.sin (lat)
+    rho_cos = math.cos (u) + height * math.cos (lat)
+    return (lat, rho_sin, rho_cos)
+
+def hour_angle (track, t):
+    '''Local apparent geocentric hour angle of the tracked body at times t.'''
+    p = interpolate (track, t)
+    return p[LST] + sidereal_rate * t - p[RA]
+
+def altitude_sine (track, site, t):
+    '''
+    Sine of the tracked body's geometric topocentric altitude at times t.
+    site is the tuple from observer_geocentric.
+    '''
+    lat, rho_sin, rho_cos = site
+    p = interpolate (track, t)
+    ha = p[LST] + sidereal_rate * t - p[RA]
+    cos_dec = numpy.cos (p[DEC])
+    # Direction to the body from the observer rather than from the earth's
+    # center, in the hour angle frame.
+    x = cos_dec * numpy.cos (ha) - rho_cos * p[PARALLAX]
+    y = cos_dec * numpy.sin (ha)
+    z = numpy.sin (p[DEC]) - rho_sin * p[PARALLAX]
+    return ((math.sin (lat) * z + math.cos (lat) * x)
+            / numpy.sqrt (x * x + y * y + z * z))
+
+def turning_points (func, t, h, iterations = turn_iterations):
+    '''
+    Refine the times t where the vectorized func peaks or dips, each known
+    to within h days, by successive parabolas through three points.
+    Returns the times and func's values there.
+    '''
+    low, high = t - h, t + h
+    for _ in range (iterations):
+        v0, v1, v2 = func (t - h), func (t), func (t + h)
+        curve = v0 - 2 * v1 + v2
+        shift = h * (v0 - v2) / (2 * numpy.where (curve != 0, curve, 1))
+        t = numpy.clip (t + numpy.clip (shift, -h, h), low, high)
+        h = h / 4
+    return t, func (t)
+
+def find_crossings (func, grid, values, rising, tolerance = refine_tolerance):
+    '''
+    Find where func (a vectorized function of time, already evaluated as
+    values on grid) crosses zero going upward (rising True) or downward
+    (rising False). Brackets the sign changes on the grid, and those
+    hidden between grid points near a turning point, and then refines all
+    of them at once to within tolerance seconds. Crossings that do not
+    converge are left out.
+    Returns a sorted numpy array of times.
+    '''
+    sign = 1 if rising else -1
+    g = lambda t: sign * func (t)
+    values = sign * values
+    hits = numpy.nonzero ((values[:-1] < 0) & (values[1:] >= 0))[0]
+    a, b = grid[hits], grid[hits+1]
+    f_a, f_b = values[hits], values[hits+1]
+    # A body that only just reaches the horizon (twilight near midsummer,
+    # say) can rise and set between two grid points, so the grid shows no
+    # sign change. Where the grid values turn without changing sign, find
+    # the turning point: if it is on the other side of zero, it splits the
+    # steps around it into two brackets, one of them upward.
+    v0, v1, v2 = values[:-2], values[1:-1], values[2:]
+    peaks = (v1 >= v0) & (v1 >= v2) & (v0 < 0) & (v1 < 0) & (v2 < 0)
+    dips = (v1 <= v0) & (v1 <= v2) & (v0 >= 0) & (v1 >= 0) & (v2 >= 0)
+    for turns, peak in ((peaks, True), (dips, False)):
+        j = numpy.nonzero (turns)[0] + 1
+        if not len (j):
+            continue
+        t, f_t = turning_points (g, grid[j], grid[j+1] - grid[j])
+        split = (f_t >= 0) if peak else (f_t < 0)
+        j, t, f_t = j[split], t[split], f_t[split]
+        if peak:
+            # The upward crossing comes before the peak.
+            a, f_a = numpy.append (a, grid[j-1]), numpy.append (f_a, values[j-1])
+            b, f_b = numpy.append (b, t), numpy.append (f_b, f_t)
+        else:
+            # The upward crossing comes after the dip.
+            a, f_a = numpy.append (a, t), numpy.append (f_a, f_t)
+            b, f_b = numpy.append (b, grid[j+1]), numpy.append (f_b, values[j+1])
+    # Illinois steps: regula falsi inside the bracket, halving the value
+    # at an end that has stayed put twice so that both ends converge.
+    tolerance = tolerance / 86400.0
+    found = numpy.full (len (a), math.nan)
+    left = numpy.arange (len (a))
+    last = numpy.full (len (a), math.nan)
+    side = numpy.zeros (len (a))
+    for _ in range (refine_max_iterations):
+        if not len (left):
+            break
+        c = (a * f_b - b * f_a) / (f_b - f_a)
+        f_c = g (c)
+        below = f_c < 0
+        f_b = numpy.where (below & (side < 0), f_b / 2, f_b)
+        f_a = numpy.where (~below & (side > 0), f_a / 2, f_a)
+        a, f_a = numpy.where (below, c, a), numpy.where (below, f_c, f_a)
+        b, f_b = numpy.where (below, b, c), numpy.where (below, f_b, f_c)
+        side = numpy.where (below, -1, 1)
+        done = ((abs (c - last) < tolerance) | (b - a < tolerance)
+                | (f_c == 0))
+        found[left[done]] = c[done]
+        keep = ~done
+        left, last, side = left[keep], c[keep], side[keep]
+        a, b, f_a, f_b = a[keep], b[keep], f_a[keep], f_b[keep]
+    return numpy.sort (found[~numpy.isnan (found)])
+
+def next_events (events, starts):
+    '''
+    For each start time, hours until the first of events within one day,
+    or NaN if there is none. Same convention as hours_after.
+    '''
+    k = numpy.searchsorted (events, starts)
+    found = numpy.full (len (starts), math.nan)
+    ok = k < len (events)
+    h = hours_after (events[k[ok]], starts[ok])
+    found[ok] = numpy.where (h > 24, math.nan, h)
+    return found
+
+# Kinds of day for a body and horizon, from day_classes.
+NORMAL, ALWAYS_UP, NEVER_UP = range (3)
+
+day_class_samples = 4               # declinations looked at per day
+day_class_margin = math.radians (0.1)   # slack for interpolation
+
+def day_classes (track, where, first, day_count, horizon):
+    '''
+    Classify each of day_count days from ephem.Date first (a float) by
+    whether the tracked body can cross horizon (a string, as for
+    Observer.horizon) that day: ALWAYS_UP if it stays above it all day,
+    NEVER_UP if it stays below, NORMAL otherwise.
+    Only the declination's range over the day and the observer's latitude
+    are used, with a margin for parallax, so ALWAYS_UP and NEVER_UP are
+    certain while a NORMAL day may still have no rising or setting.
+    Returns a numpy array of day_count classes.
+    '''
+    lat = float (where.lat)
+    t = first + numpy.arange (day_count * day_class_samples + 1) / day_class_samples
+    p = interpolate (track, t)
+    dec = p[DEC]
+    # Same target altitude as event_hours.
+    h0 = numpy.interp (t, track["times"], [ephem.unrefract (where.pressure,
+            where.temp, ephem.degrees (horizon) - r) for r in track["radius"]])
+    def day_min (v):
+        return numpy.minimum (v[:-1].reshape (day_count, -1).min (axis=1),
+                v[day_class_samples::day_class_samples])
+    def day_max (v):
+        return -day_min (-v)
+    dec_low, dec_high = day_min (dec), day_max (dec)
+    # Highest and lowest geocentric altitudes at upper and lower
+    # culmination, over the day's range of declinations.
+    highest = math.pi / 2 - numpy.where ((dec_low <= lat) & (lat <= dec_high),
+            0, numpy.minimum (abs (lat - dec_low), abs (lat - dec_high)))
+    lowest = numpy.where ((dec_low <= -lat) & (-lat <= dec_high),
+            0, numpy.minimum (abs (lat + dec_low), abs (lat + dec_high))) - math.pi / 2
+    # Parallax lowers the topocentric altitude by up to the parallax.
+    parallax = day_max (p[PARALLAX])
+    classes = numpy.full (day_count, NORMAL)
+    classes[lowest - parallax - day_class_margin > day_max (h0)] = ALWAYS_UP
+    classes[highest + day_class_margin < day_min (h0)] = NEVER_UP
+    return classes
+
+star_iterations = 1     # Newton steps from the mean sidereal estimate
+
+def fixed_event_hours (object, where, first, day_count, horizons,
+        do_rise = True, do_set = True, do_transit = True,
+        do_anti_transit = False, step = None):
+    '''
+    event_hours for a fixed star, from its hour angle directly rather than
+    by searching a grid: it transits when the local sidereal time reaches
+    its right ascension, and rises and sets at the hour angles where its
+    declination meets the horizon for the site's latitude. Each day's
+    event is estimated from the sidereal rate and then corrected with the
+    apparent place (precession, nutation and aberration) at that time.
+    '''
+    if step == None:
+        step = choose_knot_step (object)
+    first = float (first)
+    with span ("sample_positions", body=object.name, days=day_count):
+        track = sample_positions (object, where, first, first + day_count + 1,
+                step)
+    starts = first + numpy.arange (day_count) * 1.0
+    lat = float (where.lat)
+    turn = 2 * math.pi
+    at_starts = interpolate (track, starts)
+
+    def next_at (target):
+        '''Hours from each start to when the hour angle is next
+        target (a function of the declination), NaN where it never is.'''
+        p = at_starts
+        ha = p[LST] + sidereal_rate * starts - p[RA]
+        angle = target (p[DEC])
+        never = numpy.isnan (angle)
+        t = starts + numpy.remainder (numpy.where (never, ha, angle) - ha,
+                turn) / sidereal_rate
+        for _ in range (star_iterations):
+            p = interpolate (track, t)
+            ha = p[LST] + sidereal_rate * t - p[RA]
+            angle = target (p[DEC])
+            never |= numpy.isnan (angle)
+            t = t - numpy.where (never, 0, numpy.remainder (ha - angle
+                    + math.pi, turn) - math.pi) / sidereal_rate
+        # A correction across the start of the day means the next one.
+        t = numpy.where (t < starts, t + turn / sidereal_rate, t)
+        h = hours_after (t, starts)
+        return numpy.where (never | (h > 24), math.nan, h)
+
+    shared = {}
+    if do_transit:
+        with span ("transit", body=object.name, days=day_count):
+            shared["transit"] = next_at (lambda dec: 0.0)
+    if do_anti_transit:
+        with span ("antitransit", body=object.name, days=day_count):
+            shared["antitransit"] = next_at (lambda dec: math.pi)
+    result = {}
+    for horizon in horizons:
+        result[horizon] = dict (shared)
+        if not (do_rise or do_set):
+            continue
+        # Same target altitude as event_hours.
+        sin_h0 = math.sin (ephem.unrefract (where.pressure, where.temp,
+                ephem.degrees (horizon) - track["radius"][0]))
+        def set_angle (dec):
+            # NaN where the star never crosses the horizon.
+            with numpy.errstate (invalid='ignore'):
+                return numpy.arccos ((sin_h0 - math.sin (lat) * numpy.sin (dec))
+                        / (math.cos (lat) * numpy.cos (dec)))
+        if do_set:
+            with span ("set", body=object.name, horizon=horizon, days=day_count):
+                result[horizon]["set"] = next_at (set_angle)
+        if do_rise:
+            with span ("rise", body=object.name, horizon=horizon, days=day_count):
+                result[horizon]["rise"] = next_at (lambda dec: -set_angle (dec))
+    return result
+
+def event_hours (object, where, first, day_count, horizons,
+        do_rise = True, do_set = True, do_transit = True,
+        do_anti_transit = False, step = None, spacing = grid_step,
+        tolerance = refine_tolerance):
+    '''
+    Vectorized counterpart of the pyephem searches in rise_set_transit.
+    For each of day_count days starting at ephem.Date first, compute the
+    hours after the start of the day of the object's next set, rise,
+    transit and anti-transit.
+    horizons is a list of horizon strings (as for Observer.horizon);
+    rise and set are computed for each.
+    step is the days between position samples (default from
+    choose_knot_step), spacing the days between grid points, and
+    tolerance the seconds to refine each crossing to.
+    Returns a dict of horizon -> dict of event -> numpy array (transit and
+    anti-transit are shared by every horizon).
+    Fixed stars go to fixed_event_hours.
+    '''
+    if isinstance (object, ephem.FixedBody):
+        return fixed_event_hours (object, where, first, day_count, horizons,
+                do_rise, do_set, do_transit, do_anti_transit, step)
+    if step == None:
+        step = choose_knot_step (object)
+    first = float (first)
+    with span ("sample_positions", body=object.name, days=day_count):
+        track = sample_positions (object, where, first, first + day_count + 1,
+                step)
+    # Grid points sit on multiples of spacing, like the knots, so that
+    # they do not depend on first either.
+    grid = spacing * numpy.arange (math.floor (first / spacing),
+            math.ceil ((first + day_count + 1) / spacing) + 1)
+    starts = first + numpy.arange (day_count) * 1.0
+    shared = {}
+    sin_ha = lambda t: numpy.sin (hour_angle (track, t))
+    if do_transit:
+        with span ("transit", body=object.name, days=day_count):
+            values = sin_ha (grid)
+            shared["transit"] = next_events (
+                    find_crossings (sin_ha, grid, values, True,
+                    tolerance), starts)
+    if do_anti_transit:
+        with span ("antitransit", body=object.name, days=day_count):
+            values = sin_ha (grid)
+            shared["antitransit"] = next_events (
+                    find_crossings (sin_ha, grid, values, False,
+                    tolerance), starts)
+    result = {}
+    if do_rise or do_set:
+        site = observer_geocentric (where)
+        with span ("altitude", body=object.name, days=day_count):
+            altitude = altitude_sine (track, site, grid)
+    for horizon in horizons:
+        result[horizon] = dict (shared)
+        if not (do_rise or do_set):
+            continue
+        # Same target altitude as pyephem: lower the horizon by the
+        # body's radius, then undo refraction. Both vary slowly enough
+        # for linear interpolation.
+        sin_h0 = [math.sin (ephem.unrefract (where.pressure, where.temp,
+                ephem.degrees (horizon) - r)) for r in track["radius"]]
+        above = lambda t: (altitude_sine (track, site, t)
+                - numpy.interp (t, track["times"], sin_h0))
+        if not (day_classes (track, where, first, day_count, horizon)
+                == NORMAL).any ():
+            # Up, or down, throughout: nothing to search for.
+            if do_set: result[horizon]["set"] = numpy.full (day_count, math.nan)
+            if do_rise: result[horizon]["rise"] = numpy.full (day_count, math.nan)
+            continue
+        values = altitude - numpy.interp (grid, track["times"], sin_h0)
+        if do_set:
+            with span ("set", body=object.name, horizon=horizon, days=day_count):
+                result[horizon]["set"] = next_events (
+                        find_crossings (above, grid, values, False,
+                        tolerance), starts)
+        if do_rise:
+            with span ("rise", body=object.name, horizon=horizon, days=day_count):
+                result[horizon]["rise"] = next_events (
+                        find_crossings (above, grid, values, True,
+                        tolerance), starts)
+    return result
+
+def event_keys (horizons, do_rise = True, do_set = True, do_transit = True,
+        do_anti_transit = False):
+    '''(horizon, event) pairs wanted from event_hours. Transits do not
+    depend on the horizon, so their horizon is "".'''
+    wanted = []
+    if do_transit: wanted.append (("", "transit"))
+    if do_anti_transit: wanted.append (("", "antitransit"))
+    for horizon in horizons:
+        if do_set: wanted.append ((horizon, "set"))
+        if do_rise: wanted.append ((horizon, "rise"))
+    return wanted
+
+class EventCache:
+    '''
+    Persistent cache of event hours in an SQLite file, one row per body,
+    horizon, event and day, keyed by site and engine.
+    Overlapping date ranges reuse the cached days and compute only the
+    missing ones. Whole series (site, body, horizon, event, engine) are
+    evicted least recently used first once the file outgrows max_bytes.
+    '''
+    def __init__ (self, path, max_bytes):
+        os.makedirs (os.path.dirname (path) or '.', exist_ok=True)
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect (path, timeout=60)
+        self.db.executescript ('''
+            CREATE TABLE IF NOT EXISTS series (
+                id INTEGER PRIMARY KEY,
+                site TEXT, body TEXT, horizon TEXT, event TEXT, engine TEXT,
+                last_used REAL,
+                UNIQUE (site, body, horizon, event, engine));
+            CREATE TABLE IF NOT EXISTS hours (
+                series INTEGER, day REAL, hours REAL,
+                PRIMARY KEY (series, day)) WITHOUT ROWID;
+            ''')
+
+    def clear (self):
+        with self.db:
+            self.db.execute ('DELETE FROM hours')
+            self.db.execute ('DELETE FROM series')
+        self.db.execute ('VACUUM')
+
+    def series_id (self, site, body, horizon, event, engine):
+        key = (site, body, horizon, event, engine)
+        row = self.db.execute ('''SELECT id FROM series WHERE site=? AND
+                body=? AND horizon=? AND event=? AND engine=?''', key).fetchone ()
+        if row == None:
+            return self.db.execute ('''INSERT INTO series (site, body,
+                    horizon, event, engine, last_used) VALUES
+                    (?, ?, ?, ?, ?, ?)''', key + (time.time (),)).lastrowid
+        self.db.execute ('UPDATE series SET last_used=? WHERE id=?',
+                (time.time (), row[0]))
+        return row[0]
+
+    def lookup (self, engine, object, where, first, day_count, wanted):
+        '''
+        Cached hours of object's events for day_count days from first.
+        wanted is a list of (horizon, event) pairs from event_keys.
+        Returns the series ids and hours (both dicts by wanted pair),
+        and a boolean array of the days missing from any of them.
+        '''
+        site = "%.6f %.6f %.1f %.1f %.1f" % (math.degrees (where.lat),
+                math.degrees (where.lon), where.elevation, where.pressure,
+                where.temp)
+        series = {}
+        hours = {}
+        missing = numpy.zeros (day_count, dtype=bool)
+        with self.db:
+            for key in wanted:
+                series[key] = self.series_id (site, object.name, key[0],
+                        key[1], engine)
+                values = numpy.full (day_count, math.nan)
+                found = numpy.zeros (day_count, dtype=bool)
+                for day, h in self.db.execute ('''SELECT day, hours FROM hours
+                        WHERE series=? AND day BETWEEN ? AND ?''',
+                        (series[key], first - 0.5, first + day_count - 0.5)):
+                    i = int (round (day - first))
+                    values[i] = math.nan if h == None else h
+                    found[i] = True
+                hours[key] = values
+                missing |= ~found
+        return series, hours, missing
+
+    def store (self, series, hours, first, begin, end):
+        '''Save days begin up to end of hours (as from lookup).'''
+        with self.db:
+            for key in series:
+                self.db.executemany ('''INSERT OR REPLACE INTO hours
+                        (series, day, hours) VALUES (?, ?, ?)''',
+                        ((series[key], round (first + i, 6),
+                            None if math.isnan (hours[key][i])
+                            else float (hours[key][i]))
+                        for i in range (begin, end)))
+
+    def evict (self):
+        '''Drop least recently used series until the file fits max_bytes.'''
+        def size ():
+            pages = self.db.execute ('PRAGMA page_count').fetchone ()[0]
+            free = self.db.execute ('PRAGMA freelist_count').fetchone ()[0]
+            page_size = self.db.execute ('PRAGMA page_size').fetchone ()[0]
+            return (pages - free) * page_size
+        while size () > self.max_bytes:
+            row = self.db.execute ('''SELECT id FROM series
+                    ORDER BY last_used LIMIT 1''').fetchone ()
+            if row == None:
+                break
+            with self.db:
+                self.db.execute ('DELETE FROM hours WHERE series=?', row)
+                self.db.execute ('DELETE FROM series WHERE id=?', row)
+
+# pyephem bodies and observers cannot be pickled, so work sent to a process
+# pool describes them instead.
+
+def body_spec (object):
+    '''A picklable description of object, for make_body.'''
+    # Asteroids and comets are Planets too, but made from orbital elements.
+    if isinstance (object, ephem.Planet) and not isinstance (object,
+            (ephem.EllipticalBody, ephem.HyperbolicBody, ephem.ParabolicBody)):
+        return ("planet", type (object).__name__)
+    if isinstance (object, ephem.FixedBody):
+        return ("fixed", object.name, float (object._ra),
+                float (object._dec), float (object._epoch),
+                object._pmra, object._pmdec)
+    return ("db", object.writedb ())
+
+def make_body (spec):
+    if spec[0] == "planet":
+        return getattr (ephem, spec[1]) ()
+    if spec[0] == "fixed":
+        object = ephem.FixedBody ()
+        (object.name, object._ra, object._dec,
+                object._epoch, object._pmra, object._pmdec) = spec[1:]
+        return object
+    return ephem.readdb (spec[1])
+
+def observer_spec (where):
+    '''A picklable description of where, for make_observer.'''
+    return (float (where.lat), float (where.lon), where.elevation,
+            where.pressure, where.temp, float (where.epoch))
+
+def make_observer (spec):
+    observer = ephem.Observer ()
+    (observer.lat, observer.lon, observer.elevation, observer.pressure,
+            observer.temp, observer.epoch) = spec
+    return observer
+
+# Settings of event_hours for the vector engine and its coarser precision
+# tiers: knot steps as a multiple of choose_knot_step's, grid spacing in
+# days, and refinement tolerance in seconds.
+vector_settings = {}
+vector_settings["vector"] = (1, grid_step, refine_tolerance)
+vector_settings["print"]  = (4, 1.0 / 12, 1.0)  # within a minute
+vector_settings["draft"]  = (8, 1.0 / 8, 10.0)  # within about ten minutes
+
+# Engine of each --precision tier.
+precision_engines = {}
+precision_engines["draft"] = "draft"
+precision_engines["print"] = "print"
+precision_engines["exact"] = "pyephem"
+
+def event_hours_job (engine, body, site, first, day_count, horizons, flags):
+    '''Process pool entry point: event_hours (or event_hours_search, for
+    the pyephem and adaptive engines) for a body and site given as specs.'''
+    if engine in vector_settings:
+        object = make_body (body)
+        scale, spacing, tolerance = vector_settings[engine]
+        return event_hours (object, make_observer (site), first, day_count,
+                horizons, *flags, step=scale * choose_knot_step (object),
+                spacing=spacing, tolerance=tolerance)
+    if engine == 'pyephem':
+        return event_hours_search (make_body (body), make_observer (site),
+                first, day_count, horizons, *flags)
+    if engine == 'adaptive':
+        return event_hours_search (make_body (body), make_observer (site),
+                first, day_count, horizons, *flags,
+                tolerance=adaptive_tolerance)
+    raise ValueError ("unknown engine %r" % (engine,))
+
+def worker_count (jobs):
+    '''jobs (--jobs), but no more than there are CPUs to run them.'''
+    return max (1, min (jobs, os.cpu_count () or 1))
+
+def process_pool (jobs):
+    '''
+    A pool of jobs worker processes, or one a CPU if there are fewer
+    CPUs. Where possible the workers are forked, so that they start out
+    with position_memo.
+    '''
+    if "fork" in multiprocessing.get_all_start_methods ():
+        context = multiprocessing.get_context ("fork")
+    else:
+        context = None
+    return concurrent.futures.ProcessPoolExecutor (worker_count (jobs),
+            mp_context=context)
+
+def cached_engine (engine):
+    '''Name engine's results are cached under. Adaptive results depend on
+    the tolerance.'''
+    if engine == 'adaptive':
+        return "adaptive %g" % (adaptive_tolerance,)
+    return engine
+
+# Fewest days worth sending to a worker on their own.
+min_job_days = 31
+# Fewest days of one body's searches, over all the bodies, worth starting
+# worker processes for. The vector engines take well under a second for
+# years of days, less than the workers take to start and send back their
+# results, so they are never sent to workers.
+min_pool_days = 1000
+
+def compute_event_hours_many (requests, where, first, day_count,
+        engine = 'vector', jobs = 1, cache = None):
+    '''
+    Event hours (as returned by event_hours) for several bodies, from the
+    'vector', 'pyephem' or 'adaptive' engine, or a precision tier's
+    ('draft', 'print'), going through cache (an EventCache) unless it is
+    None.
+    requests is a list of (object, horizons, flags), flags being the
+    (do_rise, do_set, do_transit, do_anti_transit) tuple.
+    With jobs > 1 the days still to compute by the pyephem searches are
+    split by body and date range across a pool of worker processes, when
+    there are at least min_pool_days of them; results are merged in request
+    order so they do not depend on which worker finishes first.
+    Returns a list with one result per request.
+    '''
+    first = float (first)
+    plans = []
+    runs = []
+    for object, horizons, flags in requests:
+        wanted = event_keys (horizons, *flags)
+        if cache == None:
+            series = None
+            hours = {key: numpy.full (day_count, math.nan) for key in wanted}
+            missing = numpy.ones (day_count, dtype=bool)
+        else:
+            with span ("event_cache_lookup", body=object.name):
+                series, hours, missing = cache.lookup (
+                        cached_engine (engine), object, where, first,
+                        day_count, wanted)
+        plans.append ((object, horizons, flags, series, hours))
+        edges = numpy.diff (numpy.concatenate (([0], missing.view (numpy.int8), [0])))
+        for begin, end in zip (numpy.nonzero (edges == 1)[0],
+                numpy.nonzero (edges == -1)[0]):
+            runs.append ((len (plans) - 1, int (begin), int (end)))
+    jobs = worker_count (jobs)
+    if (engine in vector_settings
+            or sum (end - begin for p, begin, end in runs) < min_pool_days):
+        jobs = 1
+    # Runs of missing days, cut into pieces for the workers. The pyephem
+    # searches carry state through each search_block, so their pieces are
+    # cut only at block boundaries.
+    work = []
+    for p, begin, end in runs:
+        if jobs == 1:
+            work.append ((p, begin, end))
+            continue
+        size = max (min_job_days, int (math.ceil ((end - begin) / jobs)))
+        size = int (math.ceil (size / search_block)) * search_block
+        cut = begin - search_lead (first + begin)
+        for b in range (cut, end, size):
+            work.append ((p, max (b, begin), min (b + size, end)))
+    specs = [(engine, body_spec (plans[p][0]), observer_spec (where),
+            first + begin, end - begin, plans[p][1], plans[p][2])
+            for p, begin, end in work]
+    if jobs > 1 and len (work) > 1:
+        # Worker processes are not traced; this span covers them all.
+        with span ("event_hours_pool", jobs=jobs, pieces=len (work)):
+            with process_pool (jobs) as pool:
+                futures = [pool.submit (event_hours_job, *spec) for spec in specs]
+                results = [future.result () for future in futures]
+    else:
+        results = []
+        for (p, begin, end), spec in zip (work, specs):
+            with span ("event_hours", body=plans[p][0].name, engine=engine,
+                    days=end - begin):
+                results.append (event_hours_job (*spec))
+    with span ("event_cache_store"):
+        for (p, begin, end), computed in zip (work, results):
+            object, horizons, flags, series, hours = plans[p]
+            for key in hours:
+                hours[key][begin:end] = computed[key[0] or horizons[0]][key[1]]
+            if series != None:
+                cache.store (series, hours, first, begin, end)
+        if cache != None and work:
+            cache.evict ()
+    result = []
+    for object, horizons, flags, series, hours in plans:
+        by_horizon = {}
+        for horizon in horizons:
+            by_horizon[horizon] = {}
+            for key in hours:
+                if key[0] in ("", horizon):
+                    by_horizon[horizon][key[1]] = hours[key].copy ()
+        result.append (by_horizon)
+    return result
+
+class EventTimes:
+    '''
+    Event times of an almanac in hours after local noon: one preallocated
+    2-D float64 array, hours, with a row per (name, event) and a column per
+    day, NaN where there is no event.
+    times[name][event] is a view of a row, so it can be handed to numpy and
+    matplotlib without copying.
+    '''
+    def __init__ (self, keys, day_count, hours = None):
+        '''keys lists the (name, event) rows. hours, if given, is the
+        array to use; otherwise it is allocated full of NaN.'''
+        self.keys = [tuple (key) for key in keys]
+        self.index = {}
+        for row, (name, event) in enumerate (self.keys):
+            self.index.setdefault (name, {})[event] = row
+        if hours is None:
+            hours = numpy.full ((len (self.keys), day_count), math.nan)
+        self.hours = hours
+
+    def __len__ (self):
+        return self.hours.shape[1]
+
+    def __iter__ (self):
+        return iter (self.index)
+
+    def __contains__ (self, name):
+        return name in self.index
+
+    def __getitem__ (self, name):
+        '''Row views of name's events, by event.'''
+        return {event: self.hours[row]
+                for event, row in self.index[name].items ()}
+
+    def row (self, name, event):
+        '''The view of the row for name's event.'''
+        return self.hours[self.index[name][event]]
+
+    def write (self, f):
+        '''Write to the binary file f: a one line JSON header, then the
+        whole array in a single write.'''
+        header = dict (keys=self.keys, days=len (self),
+                dtype=self.hours.dtype.str)
+        f.write (json.dumps (header).encode () + b"\n")
+        f.write (numpy.ascontiguousarray (self.hours).data)
+
+    @classmethod
+    def read (cls, f):
+        '''Read EventTimes written by write from the binary file f.'''
+        header = json.loads (f.readline ())
+        hours = numpy.frombuffer (bytearray (f.read ()), header["dtype"])
+        return cls (header["keys"], header["days"],
+                hours.reshape (len (header["keys"]), header["days"]))
+
+def save_event_hours (name, hours, times, mask = True, debug = False):
+    '''Save event hours (one horizon's dict from event_hours) for name in
+    times, an EventTimes with rows for them. With mask, hide events that
+    happen while the sun is up. debug lists the saved times.'''
+    events = [event for event in event_search if event in hours]
+    for event in events:
+        row = times.row (name, event)
+        row[:] = hours[event]
+        # If object rises, sets, or transits while sun is up, do not plot it.
+        if mask:
+            row[(row > times["sun"]["rise"]) | (row < times["sun"]["set"])] = math.nan
+    if debug:
+        print ("%-3s" % ("day",) + "".join (
+            "  %7s" % (event,) for event in events))
+        for i in range (len (hours[events[0]])):
+            print ("%-3d" % (i,) + "".join (
+                "  %7.4f" % (times[name][event][i],) for event in events))
+    if verbose:
+        print (name, end=' ')
+        show_elapsed_time()
+
+def rise_set_transit (object, name, where, times, day_count, horizon = '0',
         do_rise = True, do_set = True, do_transit = True,
-        do_anti_transit = False, debug = False):
-    '''Compute, and save in times dictionary, the rising, setting, and transit 
-    times of object.
+        do_anti_transit = False, debug = False,
+        engine = 'vector', jobs = 1, cache = None):
+    '''Compute, and save in times (an EventTimes with rows for name), the
+    rising, setting, and transit times of object for day_count days starting
+    at where.date.
     horizon defaults to zero (note that it is a string), but can be changed for
     computing civil, nautical, and astronomical twilight times.
     debug lists the rise, set, and transit times.
     do_transit flags whether to compute the transit time.
-    do_anti_transit flags whether to comput the anti-transit time.'''
-    if not name in times:
-        times[name] = {}
-    if do_set    : times[name]["set"] = []
-    if do_rise   : times[name]["rise"] = []
-    if do_transit: times[name]["transit"] = []
-    if do_anti_transit: times[name]["antitransit"] = []
-    where.date = start_date
-    where.horizon = horizon
-    if debug:
-        show = "%-3s" % ("day", )
-        if do_set: show += "  %7s" % ("set",)
-        if do_rise: show += "  %7s" % ("rise",)
-        if do_transit: show += "  %7s" % ("transit",)
-        if do_anti_transit: show += "  %7s" % ("antitransit",)
-        print (show)
-    for i in days:
-        if name != "sun":
-            sun_rise = times["sun"]["rise"][i]
-            sun_set  = times["sun"]["set"][i]
-        if name == "moon" and debug:
-            print ("%s %s" % (where.next_rising(object), where.next_setting(object)))
-        if do_set:
-            h = (hours_after (where.next_setting(object), where.date))
-            if h > 24 :
-                h = math.nan
-            # If object sets while sun is up, do not plot it.
-            if name != "sun" and (h > sun_rise or h < sun_set):
-                h = math.nan
-            times[name]["set"].append (h)
-        if do_rise:
-            h = (hours_after (where.next_rising(object), where.date))
-            if h > 24 :
-                h = math.nan
-            # If object rises while sun is up, do not plot it.
-            if name != "sun" and (h > sun_rise or h < sun_set):
-                h = math.nan
-            times[name]["rise"].append (h)
-        if do_transit:
-            h = (hours_after (where.next_transit(object), where.date))
-            if h > 24 :
-                h = math.nan
-            # If object transits while sun is up, do not plot it.
-            if name != "sun" and (h > sun_rise or h < sun_set):
-                h = math.nan
-            times[name]["transit"].append (h)
-        if do_anti_transit:
-            h = (hours_after (where.next_antitransit(object), where.date))
-            if h > 24 :
-                h = math.nan
-            # If object anti-transits while sun is up, do not plot it.
-            if name != "sun" and (h > sun_rise or h < sun_set):
-                h = math.nan
-            times[name]["antitransit"].append (h)
-        if debug:
-            show = "%-3d" % (i, )
-            if do_set: show += "  %7.4f" % (times[name]["set"][i],)
-            if do_rise: show += "  %7.4f" % (times[name]["rise"][i],)
-            if do_transit: show += "  %7.4f" % (times[name]["transit"][i],)
-            if do_anti_transit: show += "  %7.4f" % (times[name]["antitransit"][i],)
-            print (show)
-        where.date = where.date + oneday
-    print (name, end=' ')
-    show_elapsed_time()
+    do_anti_transit flags whether to comput the anti-transit time.
+    engine, jobs and cache are as for compute_event_hours_many.'''
+    flags = (do_rise, do_set, do_transit, do_anti_transit)
+    hours = compute_event_hours_many ([(object, [horizon], flags)], where,
+            where.date, day_count, engine, jobs, cache)[0][horizon]
+    save_event_hours (name, hours, times,
+            not isinstance (object, ephem.Sun), debug)
+
+def rise_set_transit_many (requests, where, times, day_count,
+        engine = 'vector', jobs = 1, cache = None):
+    '''Same as calling rise_set_transit (object, name, where, times,
+    day_count, **kwargs) for each (object, name, kwargs) in requests, but
+    computing them all together, in parallel when jobs > 1.'''
+    work = []
+    for object, name, kwargs in requests:
+        horizon = kwargs.get ("horizon", '0')
+        flags = (kwargs.get ("do_rise", True), kwargs.get ("do_set", True),
+                kwargs.get ("do_transit", True),
+                kwargs.get ("do_anti_transit", False))
+        work.append ((object, [horizon], flags))
+    results = compute_event_hours_many (work, where, where.date, day_count,
+            engine, jobs, cache)
+    for (object, name, kwargs), (_, horizons, _), hours in zip (
+            requests, work, results):
+        save_event_hours (name, hours[horizons[0]], times,
+                not isinstance (object, ephem.Sun),
+                kwargs.get ("debug", False))
+
+def sun_rise_set (where, times, day_count, horizons,
+        engine = 'vector', jobs = 1, cache = None):
+    '''Compute, and save in times (an EventTimes), sun rise and set for each
+    horizons entry (name -> horizon string), for day_count days starting
+    at where.date. The vector engine gets every horizon from one set of
+    solar positions, so extra horizons cost very little.'''
+    hours = compute_event_hours_many ([(ephem.Sun(), list (horizons.values ()),
+            (True, True, False, False))], where, where.date, day_count,
+            engine, jobs, cache)[0]
+    for name, horizon in horizons.items ():
+        times.row (name, "set")[:] = hours[horizon]["set"]
+        times.row (name, "rise")[:] = hours[horizon]["rise"]
+    if verbose:
+        print (" ".join (horizons), end=' ')
+        show_elapsed_time()
 
 def choose_arg (kwname, kwargs, objname, globalargs):
     if kwname in kwargs:
@@ -309,9 +1705,13 @@ def choose_arg (kwname, kwargs, objname, globalargs):
         value = globalargs["default"]
     return value
 
-def rotated_label (label, x1, y1, x0, y0, va, color):
-    # print (label)
-    rotation = text_rotation (x1,y1, x0,y0)
+def label_position (x1, y1, x0, y0, va, days_in_chart):
+    '''
+    Where to put a label for a curve through (x0,y0) and (x1,y1): the text
+    centre and its rotation in degrees, following the curve, above it for
+    va="bottom" and below it for va="top".
+    '''
+    rotation = text_rotation (x1,y1, x0,y0, days_in_chart)
     # Matplotlib has odd ideas about where to place rotated text
     # with respect to the curve when va="bottom" and ha="center".
     # So use va="center" and tweak x and y to put the label where 
@@ -323,6 +1723,11 @@ def rotated_label (label, x1, y1, x0, y0, va, color):
         align_delta_multiplier = 1
     x = x1 - math.sin (radians) * 3 * align_delta_multiplier # x units in days
     y = y1 + math.cos (radians) * 0.1 * align_delta_multiplier # y units in hours
+    return (x, y, rotation)
+
+def rotated_label (axes, label, x1, y1, x0, y0, va, color, days_in_chart):
+    # print (label)
+    x, y, rotation = label_position (x1, y1, x0, y0, va, days_in_chart)
     axes.text (x, y, label,
             va="center", ha="center",
             color=color,
@@ -330,13 +1735,156 @@ def rotated_label (label, x1, y1, x0, y0, va, color):
             fontsize=obfontsize['object'])
     return
 
-def plot_object_event (times, obj, event, **kwargs):
+def series_segments (rows):
+    '''
+    Runs of non-NaN values in every row of the 2-D array rows at once.
+    Returns arrays of the row, first column and last column + 1 of each
+    run, ordered by row and then column.
+    '''
+    present = ~numpy.isnan (rows)
+    edges = numpy.zeros ((rows.shape[0], rows.shape[1] + 1), dtype=numpy.int8)
+    edges[:, :-1] = present
+    edges[:, 1:] -= present
+    starts = numpy.nonzero (edges == 1)
+    ends = numpy.nonzero (edges == -1)
+    return (starts[0], starts[1], ends[1])
+
+class LabelGrid:
+    '''
+    Spatial index of placed label boxes (xmin, ymin, xmax, ymax), in
+    display pixels, bucketed into square cells so that an overlap test only
+    looks at the boxes near it.
+    '''
+    def __init__ (self, cell):
+        self.cell = cell
+        self.boxes = []
+        self.cells = {}
+
+    def _cells (self, box):
+        c = self.cell
+        for i in range (int (box[0] // c), int (box[2] // c) + 1):
+            for j in range (int (box[1] // c), int (box[3] // c) + 1):
+                yield (i, j)
+
+    def overlaps (self, box, limit = None):
+        '''How many placed boxes box overlaps, counting no further than
+        limit.'''
+        seen = set ()
+        for key in self._cells (box):
+            for n in self.cells.get (key, ()):
+                other = self.boxes[n]
+                if (other[0] < box[2] and box[0] < other[2]
+                        and other[1] < box[3] and box[1] < other[3]):
+                    seen.add (n)
+                    if len (seen) == limit:
+                        return limit
+        return len (seen)
+
+    def add (self, box):
+        for key in self._cells (box):
+            self.cells.setdefault (key, []).append (len (self.boxes))
+        self.boxes.append (box)
+
+# Where along a curve segment to try a label, as fractions of its length,
+# best first.
+label_candidates = [0.5, 0.45, 0.55, 0.4, 0.6, 0.35, 0.65, 0.3, 0.7,
+        0.25, 0.75, 0.2, 0.8, 0.15, 0.85, 0.1, 0.9, 0.05, 0.95]
+
+# Overlaps counted before a crowded candidate is taken to be as bad as any.
+label_overlap_limit = 8
+
+# Rough size of label text: average character width and line height as
+# fractions of the font size.
+label_char_width  = 0.6
+label_line_height = 1.2
+
+class LabelLayout:
+    '''
+    Labels for the curves of plot_object_event, placed together once every
+    curve is drawn: one label per non-NaN segment of each curve, at the
+    first of label_candidates along the segment that does not overlap a
+    label already placed (or else the one that overlaps fewest).
+    Earlier labels are placed first.
+    '''
+    def __init__ (self, axes, days_in_chart):
+        self.axes = axes
+        self.days_in_chart = days_in_chart
+        self.labels = []
+        # Name of the body of each label, and (name, text) of each placed.
+        self.names = []
+        self.texts = []
+
+    def add (self, label, series, va, color, name = None):
+        '''Label each segment of series (hours by day) with label.'''
+        self.labels.append ((label, series, va, color))
+        self.names.append (name)
+
+    def place (self):
+        '''Draw every label added.'''
+        if not self.labels:
+            return
+        rows = numpy.stack ([series for label, series, va, color in self.labels])
+        which, starts, ends = series_segments (rows)
+        fractions = numpy.array (label_candidates)
+        # Day of each candidate and the day before it, within the segment.
+        mids = (starts[:, numpy.newaxis]
+                + (fractions * (ends - starts)[:, numpy.newaxis]).astype (int))
+        previous = numpy.maximum (mids - 1, starts[:, numpy.newaxis])
+        y1 = rows[which[:, numpy.newaxis], mids]
+        y0 = rows[which[:, numpy.newaxis], previous]
+        # Same as label_position, for every candidate at once.
+        slope = numpy.where (mids > previous, y1 - y0, 0.0) * (
+                self.days_in_chart * 17.0 / 365.0)
+        radians = numpy.arctan (slope)
+        sign = numpy.array ([-1 if va == "top" else 1
+                for label, series, va, color in self.labels])[which][:, numpy.newaxis]
+        x = mids - numpy.sin (radians) * 3 * sign
+        y = y1 + numpy.cos (radians) * 0.1 * sign
+        centres = self.axes.transData.transform (
+                numpy.stack ((x.ravel (), y.ravel ()), axis=1)).reshape (
+                        x.shape + (2,))
+        # Axis aligned bounding boxes of the rotated text.
+        pixels = obfontsize['object'] * self.axes.figure.dpi / 72.0
+        lengths = numpy.array ([len (label)
+                for label, series, va, color in self.labels])[which]
+        width = (lengths * label_char_width * pixels)[:, numpy.newaxis]
+        height = label_line_height * pixels
+        half_x = (numpy.abs (width * numpy.cos (radians))
+                + numpy.abs (height * numpy.sin (radians))) / 2
+        half_y = (numpy.abs (width * numpy.sin (radians))
+                + numpy.abs (height * numpy.cos (radians))) / 2
+        boxes = numpy.stack ((centres[..., 0] - half_x, centres[..., 1] - half_y,
+                centres[..., 0] + half_x, centres[..., 1] + half_y), axis=2)
+        grid = LabelGrid (max (8.0, 4 * height))
+        for n in range (len (which)):
+            best = None
+            for c in range (len (fractions)):
+                box = boxes[n, c].tolist ()
+                count = grid.overlaps (box,
+                        label_overlap_limit if best == None else best[0])
+                if best == None or count < best[0]:
+                    best = (count, c, box)
+                if count == 0:
+                    break
+            count, c, box = best
+            grid.add (box)
+            label, series, va, color = self.labels[which[n]]
+            text = self.axes.text (x[n, c], y[n, c], label,
+                    va="center", ha="center",
+                    color=color,
+                    rotation=math.degrees (radians[n, c]),
+                    fontsize=obfontsize['object'])
+            self.texts.append ((self.names[which[n]], text))
+
+def plot_object_event (axes, times, obj, event, layout = None, **kwargs):
     '''
     Plot a curve for an object event (e.g., Mercury rise).
-    Also label the object event's time plot.
-    Most event plots will have discontiguous segments. Try to place the label
-    near the middle of each segment.
+    Also label the object event's time plot: near the middle of each of its
+    discontiguous segments, avoiding other labels. The labels are added to
+    layout (a LabelLayout) to be placed with everyone else's, or placed
+    straight away if layout is None.
     '''
+    days = range (len (times))
     color = choose_arg ("color", kwargs, obj, obcolor)
     linewidth = choose_arg ("linewidth", kwargs, obj, obwidth)
     # print (obj, event, color, linewidth)
@@ -344,87 +1892,99 @@ def plot_object_event (times, obj, event, **kwargs):
             color=color, linewidth=linewidth)
     if "label" in kwargs and kwargs["label"] == None:
         return # no label wanted
-    # Now figure out where to put the label(s).
     if not "va" in kwargs:
         kwargs["va"] = "center"
     if not "label" in kwargs:
         kwargs["label"] = "%s %s" % (obj, event)
-    first_non_nan = None
-    time = times[obj][event]
-    for i in days:
-        # print ("%3d  %5.3f" % (i, time[i]))
-        if math.isnan (time[i]):
-            if first_non_nan == None:
-                # print ("nan to nan %d" % (i,))
-                pass
-            else:
-                # Compute the label position
-                mid = int ((i + first_non_nan) / 2)
-                # print ("non-nan to nan, label %s at %d,%5.3f" % (kwargs['label'], mid, time[mid]))
-                # TODO: the mid-1 might not be valid
-                rotated_label (kwargs['label'],
-                        mid, time[mid], mid-1, time[mid-1],
-                        kwargs['va'], color)
-                first_non_nan = None
-        else: # non-nan
-            if first_non_nan == None:
-                first_non_nan = i
-                # print ("nan to non-nan %d" % (i,))
-            else:
-                # print ("non-nan to non-nan %d %d %5.3f" % (i, first_non_nan, time[i]))
-                pass
-        pass
-    if first_non_nan == None:
-        # Ignore
-        pass
+    if layout == None:
+        single = LabelLayout (axes, len (days))
+        single.add (kwargs['label'], times[obj][event], kwargs['va'], color)
+        single.place ()
     else:
-        # Compute the label position
-        mid = int ((days[-1] + first_non_nan) / 2)
-        # print ("last is non-nan, label %s at %d,%5.3f" % (kwargs['label'], mid, time[mid]))
-        rotated_label (kwargs['label'],
-                mid, time[mid], mid-1, time[mid-1],
-                kwargs['va'], color)
+        layout.add (kwargs['label'], times[obj][event], kwargs['va'], color,
+                obj)
     return
 
-def plot_moon_phases (axes, days, where, times):
+def lunation_table (first, last):
+    '''
+    The new moons from the one before first to the one after last
+    (ephem.Dates), as a numpy array of ephem.Date numbers.
+    '''
+    new_moons = [ephem.previous_new_moon (first)]
+    while new_moons[-1] <= last:
+        new_moons.append (ephem.next_new_moon (new_moons[-1] + 1))
+    return numpy.array (new_moons, dtype=float)
+
+def moon_ages (when, new_moons):
+    '''
+    The moon's age (days since new moon) and the length of the lunation it
+    is in at each of the times when (numpy array of ephem.Date numbers),
+    looked up in new_moons from lunation_table.
+    '''
+    k = numpy.searchsorted (new_moons, when, side='right') - 1
+    return (when - new_moons[k], new_moons[k+1] - new_moons[k])
+
+def plot_moon_phases (axes, days, where, times, verbose = False):
     '''
     Place a marker of moon's phase at the point of moon rise or moon set,
     whichever happens after sunset on a day and before sunrise.
+    where.date is the first day.
+    All the markers are drawn as one PatchCollection.
     '''
-    where.date = start_date
-    for i in days:
-        sun_rise = times["sun"]["rise"][i]
-        sun_set  = times["sun"]["set"][i]
-        moon_rise = times["moon"]["rise"][i]
-        moon_set  = times["moon"]["set"][i]
-        prev_new_moon = ephem.previous_new_moon (where.date + sun_set/24)
-        next_new_moon = ephem.next_new_moon (where.date + sun_set/24)
-        lunation = next_new_moon - prev_new_moon
-        moon_time = math.nan
-        if math.isnan (moon_rise):
-            if math.isnan (moon_set):
-                continue
-            else:
-                moon_time = moon_set
-        else:
-            moon_time = moon_rise
-        age = where.date + moon_time/24 - prev_new_moon
-        if args.verbose:
-            print ("%3d %5.2f %5.2f %5.2f %5.2f %4.1f" % (i, sun_set, sun_rise, moon_rise, moon_set, age))
-        draw_moon_phase (i, moon_time, age, lunation)
-        where.date = where.date + oneday
+    from matplotlib.collections import PatchCollection
+    import matplotlib.patches
+    first = float (where.date)
+    days = numpy.asarray (days)
+    moon_rise = times["moon"]["rise"][days]
+    moon_set  = times["moon"]["set"][days]
+    # Moon rise if it is after dark, else moon set; times already hides
+    # those in daylight.
+    moon_time = numpy.where (numpy.isnan (moon_rise), moon_set, moon_rise)
+    shown = ~numpy.isnan (moon_time)
+    days, moon_time = days[shown], moon_time[shown]
+    if len (days) == 0:
+        return
+    when = first + days + moon_time/24
+    new_moons = lunation_table (ephem.Date (when.min ()), ephem.Date (when.max ()))
+    ages, lunations = moon_ages (when, new_moons)
+    if verbose:
+        for i, h, age in zip (days, moon_time, ages):
+            print ("%3d %5.2f %4.1f" % (i, h, age))
+    patches = []
+    colors = []
+    for x, y, age, lunation in zip (days.tolist (), moon_time.tolist (),
+            ages.tolist (), lunations.tolist ()):
+        moon, moon_color = moon_phase_path (x, y, age, lunation)
+        patches.append (matplotlib.patches.PathPatch (moon))
+        colors.append (moon_color)
+    axes.add_collection (PatchCollection (patches, facecolors=colors,
+            edgecolors='black', linewidths=1), autolim=False)
     return
 
 # Add (p1x,p1y) and (p2x,p2y)
 def add_coord (p1, p2):
     return ((p1[0] + p2[0], p1[1] + p2[1]))
 
-def draw_moon_phase (x, y, age, lunation):
+def draw_moon_phase (axes, x, y, age, lunation):
     '''
-    Draw a diagram of the moon's phase centered on (x,y).
+    Draw a diagram of the moon's phase centered on (x,y), labelled with the
+    moon's age.
+    '''
+    import matplotlib.patches
+    moon, moon_color = moon_phase_path (x, y, age, lunation)
+    moon_patch = matplotlib.patches.PathPatch (moon, facecolor=moon_color, lw=1)
+    axes.text (x, y, "%.0f" % (age,), va="center", ha="center")
+    axes.add_patch (moon_patch)
+    return
+
+def moon_phase_path (x, y, age, lunation):
+    '''
+    The outline of a diagram of the moon's phase centered on (x,y), as a
+    matplotlib Path, and the color to fill it with.
     The diagram should not be overly large.
     Make the diagram double diameter around new, full, and quarter.
     '''
+    from matplotlib.path import Path
     # http://www.charlespetzold.com/blog/2012/12/Bezier-Circles-and-Bezier-Ellipses.html
     # describes how to get bezier curves to describe circular arcs.
     # We need the control point length L to be
@@ -481,121 +2041,1401 @@ def draw_moon_phase (x, y, age, lunation):
     # Close the curve
     bezier_verts.append (moon_upper_limb)
     bezier_codes.append (Path.CLOSEPOLY)
-    moon = Path (bezier_verts, bezier_codes)
-    moon_patch = matplotlib.patches.PathPatch (moon, facecolor=moon_color, lw=1)
-    axes.text (x, y, "%.0f" % (age,), va="center", ha="center")
-    axes.add_patch (moon_patch)
-    return
+    return (Path (bezier_verts, bezier_codes), moon_color)
+
+
+def default_bodies ():
+    '''
+    Bodies charted after the sun: (body, name in times, keyword arguments
+    for rise_set_transit). A fresh list, since ephem bodies are mutable.
+    '''
+    return [
+        (ephem.Moon(), "moon", dict (do_transit=False)),
+        (ephem.Mercury(), "Mercury", dict (do_transit=False)),
+        (ephem.Venus(), "Venus", dict (do_transit=False)),
+        (ephem.Mars(), "Mars", {}),
+        (ephem.Jupiter(), "Jupiter", {}),
+        (ephem.Saturn(), "Saturn", {}),
+        (ephem.Uranus(), "Uranus", {}),
+        (ephem.Neptune(), "Neptune", {}),
+        (ephem.star("Antares"), "Antares", {}),
+        (ephem.star("Betelgeuse"), "Betelgeuse", {}),
+        (ephem.star("Pollux"), "Pollux", {}),
+        (ephem.star("Regulus"), "Regulus", {}),
+        (ephem.star("Sirius"), "Sirius", {}),
+    ]
+
+# Events drawn by render_almanac after the sun horizons, in order:
+# (name in times, event, keyword arguments for plot_object_event).
+chart_plots = [
+    ("Betelgeuse", "transit", {}),
+    ("Pollux", "transit", {}),
+    ("Regulus", "transit", {}),
+    ("Sirius", "rise", {}),
+    ("Sirius", "transit", {}),
+    ("Neptune", "rise", {}),
+    ("Neptune", "transit", {}),
+    ("Neptune", "set", {}),
+    ("Uranus", "rise", {}),
+    ("Uranus", "transit", {}),
+    ("Uranus", "set", {}),
+    ("Mercury", "rise", dict (va="top")),
+    ("Mercury", "set", {}),
+    ("Venus", "rise", dict (va="top")),
+    ("Venus", "set", {}),
+    ("Mars", "rise", {}),
+    ("Mars", "transit", {}),
+    ("Mars", "set", {}),
+    ("Jupiter", "rise", {}),
+    ("Jupiter", "transit", {}),
+    ("Jupiter", "set", {}),
+    ("Saturn", "rise", {}),
+    ("Saturn", "transit", {}),
+    ("Saturn", "set", {}),
+]
+
+# Catalogs of extra bodies to chart by their transits.
+
+def read_catalog (f, source = "catalog"):
+    '''
+    Read bodies from the text file f, one a line: either in XEphem's
+    database format (as ephem.readdb takes; e.g., an .edb file of
+    asteroids or comets, or a target list of fixed objects) or the bare
+    name of one of pyephem's stars. Blank lines and lines starting with #
+    are skipped. source names f in error messages.
+    Returns a list of ephem bodies.
+    '''
+    bodies = []
+    for n, line in enumerate (f, 1):
+        line = line.strip ()
+        if not line or line.startswith ('#'):
+            continue
+        try:
+            if ',' in line:
+                body = ephem.readdb (line)
+            else:
+                body = ephem.star (line)
+        except (ValueError, KeyError) as e:
+            raise ValueError ("%s:%d: %s" % (source, n, e))
+        if isinstance (body, ephem.EarthSatellite):
+            raise ValueError ("%s:%d: earth satellites cannot be charted"
+                    % (source, n))
+        bodies.append (body)
+    return bodies
+
+# Catalogs main has read, by path, so each --catalog file is read once and
+# any error in it is reported before anything is computed. Worker
+# processes inherit them.
+loaded_catalogs = {}
+
+def load_catalog (path):
+    '''The bodies in the catalog file at path (see read_catalog), or
+    every one of pyephem's stars for "stars".'''
+    if path in loaded_catalogs:
+        return list (loaded_catalogs[path])
+    if path == "stars":
+        return [ephem.star (name) for name in sorted (ephem.stars.stars)]
+    with open (path) as f:
+        return read_catalog (f, path)
 
-# Record the times for lots of interesting events.
-# Do the sun first since other objects' display depends on the sun being below
-# horizon.
-rise_set_transit (ephem.Sun(), "sun", here, times, do_transit=False)
-rise_set_transit (ephem.Sun(), "civil", here, times, horizon = '-6', do_transit=False)
-rise_set_transit (ephem.Sun(), "nautical", here, times, horizon = '-12', do_transit=False)
-rise_set_transit (ephem.Sun(), "astro", here, times, horizon = '-18', do_transit=False)
-
-# These times should depend on extrema of sunrise and sunset times.
-# Start plot y axis this many hours after noon localtime (no DST adjustment)
-start_plot_hour = math.floor (min(times["sun"]["set"]))
-# End plot y axis this many hours after noon localtime (no DST adjustment)
-end_plot_hour = math.ceil (max(times["sun"]["rise"]))
-print ("start_plot_hour = %s, end_plot_hour = %s" % (start_plot_hour, end_plot_hour))
-
-fig = plt.figure()
-axes = fig.add_axes([0.0, 0.0, 1.0, 1.0]) # left, bottom, width, height  range 0-1
-axes.set_xlabel("Date")
-axes.set_ylabel("hours after noon")
-
-# Normally we'd want xlim from 0-days_in_chart and ylim from start_plot_hour-
-# end_plot_hour. But we want some extra to fit labels.
-extra_border_fraction = 0.05
-extra_border_x = days_in_chart * extra_border_fraction
-extra_border_y = (end_plot_hour - start_plot_hour) * extra_border_fraction
-axes.set_xlim([0-extra_border_x,days_in_chart+extra_border_x])
-axes.set_ylim([start_plot_hour-extra_border_y,end_plot_hour+extra_border_y])
-
-# Put the date range on the chart.
-date_label_x = mid_chart if float(args.latitude) > 0 else 0
-axes.text (date_label_x, start_plot_hour-extra_border_y,
-        "%s - %s UTC%+d" % (
-            ephem.localtime (start_date).strftime ("%F"),
-            ephem.localtime (end_date).strftime ("%F"),
-            args.tzoffset),
-        va="bottom", ha="center")
-
-draw_date_lines (start_plot_hour, end_plot_hour, days, axes, times, start_date, here)
-draw_time_lines (start_plot_hour, end_plot_hour, days, axes, times)
-
-rise_set_transit (ephem.Moon(), "moon", here, times, do_transit=False)
-rise_set_transit (ephem.Mercury(), "Mercury", here, times, do_transit=False)
-rise_set_transit (ephem.Venus(), "Venus", here, times, do_transit=False)
-rise_set_transit (ephem.Mars(), "Mars", here, times)
-rise_set_transit (ephem.Jupiter(), "Jupiter", here, times)
-rise_set_transit (ephem.Saturn(), "Saturn", here, times)
-rise_set_transit (ephem.Uranus(), "Uranus", here, times)
-rise_set_transit (ephem.Neptune(), "Neptune", here, times)
-
-rise_set_transit (ephem.star("Antares"), "Antares", here, times)
-rise_set_transit (ephem.star("Betelgeuse"), "Betelgeuse", here, times)
-rise_set_transit (ephem.star("Pollux"), "Pollux", here, times)
-rise_set_transit (ephem.star("Regulus"), "Regulus", here, times)
-rise_set_transit (ephem.star("Sirius"), "Sirius", here, times)
-#rise_set_transit (ephem.star("Polaris"), "polaris", here, times, do_rise=False, do_set=False)
- 
-plot_object_event (times, "sun", "set", va="top")
-plot_object_event (times, "sun", "rise", va="bottom")
-plot_object_event (times, "civil", "set", label=None)
-plot_object_event (times, "civil", "rise", label=None)
-plot_object_event (times, "nautical", "set", label=None)
-plot_object_event (times, "nautical", "rise", label=None)
-plot_object_event (times, "astro", "set", label="evening twilight", va="top")
-plot_object_event (times, "astro", "rise", label="morning twilight", va="bottom")
-
-# When sun is down, plot moon rise time or set time with the phase of the
-# moon at that moment.
-#plot_moon_phases (axes, days, here, times)
-
-#axes.plot (days, times["moon"]["rise"], 'y')
-#axes.plot (days, times["moon"]["set"], 'g')
-
-plot_object_event (times, "Betelgeuse", "transit")
-plot_object_event (times, "Pollux", "transit")
-plot_object_event (times, "Regulus", "transit")
-plot_object_event (times, "Sirius", "rise")
-plot_object_event (times, "Sirius", "transit")
-
-plot_object_event (times, "Neptune", "rise")
-plot_object_event (times, "Neptune", "transit")
-plot_object_event (times, "Neptune", "set")
-
-plot_object_event (times, "Uranus", "rise")
-plot_object_event (times, "Uranus", "transit")
-plot_object_event (times, "Uranus", "set")
-
-plot_object_event (times, "Mercury", "rise", va="top")
-plot_object_event (times, "Mercury", "set")
-
-plot_object_event (times, "Venus", "rise", va="top")
-plot_object_event (times, "Venus", "set")
-
-plot_object_event (times, "Mars", "rise")
-plot_object_event (times, "Mars", "transit")
-plot_object_event (times, "Mars", "set")
-
-plot_object_event (times, "Jupiter", "rise")
-plot_object_event (times, "Jupiter", "transit")
-plot_object_event (times, "Jupiter", "set")
-
-plot_object_event (times, "Saturn", "rise")
-plot_object_event (times, "Saturn", "transit")
-plot_object_event (times, "Saturn", "set")
-
-#axes.plot (days, times["polaris"]["antitransit"], 'k')
-#axes.plot (days, times["polaris"]["transit"], 'k')
-
-if args.output_file != None:
-    fig.savefig (args.output_file)
-else:
-    plt.show ()
+# Days between the positions CatalogIndex keeps of moving bodies.
+catalog_sample_days = 10
+# Moving bodies CatalogIndex.visible checks at a time, to bound its memory.
+catalog_chunk = 1024
+# Pieces of the sky's circle of right ascension CatalogIndex.visible tracks
+# the nights in; a fixed star counts as transiting at night if its piece
+# does.
+catalog_ra_bins = 4096
+
+class CatalogIndex:
+    '''
+    Right ascension, declination and magnitude of a catalog's bodies from
+    ephem.Date first to last, for picking out the ones a site can see at
+    night before computing any of their events.
+    Fixed stars are positioned once, other bodies every
+    catalog_sample_days days. Bodies are indexed by their most northern
+    declination, so the ones that never get high enough are skipped by a
+    binary search.
+    '''
+    def __init__ (self, bodies, first, last):
+        self.bodies = list (bodies)
+        self.fixed = numpy.array ([isinstance (body, ephem.FixedBody)
+                for body in self.bodies], dtype=bool)
+        first, last = float (first), float (last)
+        self.times = first + catalog_sample_days * numpy.arange (
+                max (1, int (math.ceil ((last - first) / catalog_sample_days))) + 1)
+        ra = numpy.empty ((len (self.times), len (self.bodies)))
+        dec = numpy.empty (ra.shape)
+        mag = numpy.empty (ra.shape)
+        middle = ephem.Date ((first + last) / 2)
+        for j, body in enumerate (self.bodies):
+            if isinstance (body, ephem.FixedBody):
+                body.compute (middle)
+                ra[:, j], dec[:, j], mag[:, j] = body.g_ra, body.g_dec, body.mag
+                continue
+            for s, t in enumerate (self.times):
+                body.compute (ephem.Date (t))
+                ra[s, j], dec[s, j], mag[s, j] = body.g_ra, body.g_dec, body.mag
+        self.ra = numpy.unwrap (ra, axis=0)
+        self.dec = dec
+        self.mag = mag.min (axis=0)     # brightest
+        self.dec_low = dec.min (axis=0)
+        north = dec.max (axis=0)
+        self.order = numpy.argsort (north, kind='stable')
+        self.dec_high = north[self.order]
+
+    def visible (self, where, first, day_count, horizon = '0',
+            max_magnitude = None):
+        '''
+        The bodies (in catalog order) that, on at least one of day_count
+        days from ephem.Date first, transit above horizon (a string, as
+        for Observer.horizon) at where between sunset and sunrise, and
+        that are no fainter than max_magnitude.
+        '''
+        lat = float (where.lat)
+        # A body transits at 90 degrees less its distance from the zenith;
+        # refraction lifts it to horizon from a little lower.
+        reach = math.pi / 2 - ephem.unrefract (where.pressure, where.temp,
+                ephem.degrees (horizon))
+        candidates = self.order[numpy.searchsorted (self.dec_high,
+                lat - reach, side='right'):]
+        keep = self.dec_low[candidates] < lat + reach
+        if max_magnitude != None:
+            keep &= self.mag[candidates] <= max_magnitude
+        candidates = candidates[keep]
+        if len (candidates) == 0:
+            return []
+        # Each night as the local sidereal times from sunset to sunrise.
+        first = float (first)
+        sun = event_hours (ephem.Sun (), where, first, day_count,
+                [default_sun_horizons["sun"]], do_transit=False)
+        sun = sun[default_sun_horizons["sun"]]
+        starts = first + numpy.arange (day_count)
+        # Without a sunset or sunrise, count the whole day as night.
+        dusk = starts + numpy.where (numpy.isnan (sun["set"]), 0,
+                sun["set"] / 24)
+        night = numpy.where (numpy.isnan (sun["set"]) | numpy.isnan (sun["rise"]),
+                2 * math.pi, (sun["rise"] - sun["set"]) / 24 * sidereal_rate)
+        noon = where.copy ()
+        noon.date = first
+        dusk_lst = float (noon.sidereal_time ()) + sidereal_rate * (dusk - first)
+        # Fixed stars are always high enough by now, and transit at night
+        # if their right ascension is in one of the nights' ranges, marked
+        # here a bin at a time (and so slightly generously).
+        bin_width = 2 * math.pi / catalog_ra_bins
+        low = numpy.floor (numpy.remainder (dusk_lst, 2 * math.pi) / bin_width).astype (int)
+        high = numpy.minimum (low + numpy.floor (night / bin_width).astype (int) + 1,
+                low + catalog_ra_bins)
+        marks = numpy.zeros (2 * catalog_ra_bins + 1, dtype=int)
+        numpy.add.at (marks, low, 1)
+        numpy.add.at (marks, high, -1)
+        marks = numpy.cumsum (marks)
+        covered = (marks[:catalog_ra_bins] + marks[catalog_ra_bins:-1]) > 0
+        fixed = candidates[self.fixed[candidates]]
+        ra_bin = (numpy.remainder (self.ra[0, fixed], 2 * math.pi)
+                / bin_width).astype (int) % catalog_ra_bins
+        seen = [fixed[covered[ra_bin]]]
+        # Positions of moving bodies are interpolated to each dusk.
+        moving = candidates[~self.fixed[candidates]]
+        s = numpy.clip ((dusk - self.times[0]) / catalog_sample_days, 0,
+                len (self.times) - 1)
+        k = numpy.minimum (numpy.floor (s).astype (int), len (self.times) - 2)
+        w = (s - k)[:, None]
+        for c in range (0, len (moving), catalog_chunk):
+            chunk = moving[c:c+catalog_chunk]
+            ra, dec = [(1 - w) * v[k][:, chunk] + w * v[k + 1][:, chunk]
+                    for v in (self.ra, self.dec)]
+            dark = numpy.remainder (ra - dusk_lst[:, None], 2 * math.pi) <= night[:, None]
+            high = abs (lat - dec) < reach
+            seen.append (chunk[(dark & high).any (axis=0)])
+        return [self.bodies[j] for j in sorted (numpy.concatenate (seen))]
+
+def site_observer (site):
+    '''An ephem.Observer at site (a Site, or anything with its fields).'''
+    where = ephem.Observer ()
+    where.lon, where.lat, where.elev = site.longitude, site.latitude, site.elevation
+    return where
+
+def almanac_keys (bodies, sun_horizons):
+    '''The (name, event) rows of the EventTimes for bodies and sun_horizons.'''
+    keys = [(name, event) for name in sun_horizons for event in ("set", "rise")]
+    for object, name, kwargs in bodies:
+        keys += [(name, event) for horizon, event in event_keys (
+                [kwargs.get ("horizon", '0')],
+                kwargs.get ("do_rise", True), kwargs.get ("do_set", True),
+                kwargs.get ("do_transit", True),
+                kwargs.get ("do_anti_transit", False))]
+    return keys
+
+def compute_times (where, day_count, bodies, sun_horizons,
+        engine = 'vector', jobs = 1, cache = None):
+    '''
+    The EventTimes of bodies and sun_horizons for day_count days starting
+    at where.date. The arguments are as for compute_almanac.
+    '''
+    times = EventTimes (almanac_keys (bodies, sun_horizons), day_count)
+    # Do the sun first since other objects' display depends on the sun being
+    # below horizon.
+    with span ("sun_rise_set", days=day_count):
+        sun_rise_set (where, times, day_count, sun_horizons,
+                engine, jobs, cache)
+    # Everything else only waits on the sun, so compute it all together.
+    with span ("rise_set_transit_many", days=day_count, bodies=len (bodies)):
+        rise_set_transit_many (bodies, where, times, day_count,
+                engine, jobs, cache)
+    #rise_set_transit (ephem.star("Polaris"), "polaris", where, times, day_count, do_rise=False, do_set=False)
+    return times
+
+def compute_almanac (site = Site (), start = None, end = None, bodies = None,
+        sun_horizons = None, engine = 'vector', jobs = 1, cache = None):
+    '''
+    Compute the event times of an almanac for site (a Site) from start to
+    end (anything ephem.Date accepts; by default today and a year later).
+    bodies is a list like default_bodies (), which it defaults to, and
+    sun_horizons a dict like default_sun_horizons, which it defaults to.
+    engine, jobs and cache are as for compute_event_hours_many.
+    Returns a dict with the site, start_date, end_date, days_in_chart,
+    sun_horizons, engine, cached_engine (the engine's name together with
+    its settings, see cached_engine), and times, an EventTimes:
+    times[name][event] is
+    an array of hours after local noon, one per day, NaN when the event
+    does not happen (or, for bodies other than the sun, happens in
+    daylight).
+    '''
+    if bodies == None:
+        bodies = default_bodies ()
+    if sun_horizons == None:
+        sun_horizons = default_sun_horizons
+    where = site_observer (site)
+    start_date, end_date = chart_dates (start, end, site.tzoffset)
+    days_in_chart = int (end_date - start_date + 0.5)
+    where.date = start_date
+    times = compute_times (where, days_in_chart, bodies, sun_horizons,
+            engine, jobs, cache)
+    return dict (site=site, start_date=start_date, end_date=end_date,
+            days_in_chart=days_in_chart, sun_horizons=sun_horizons,
+            engine=engine, cached_engine=cached_engine (engine), times=times)
+
+def update_almanac (previous, start = None, end = None, bodies = None,
+        jobs = 1, cache = None):
+    '''
+    Move the almanac previous (from compute_almanac or update_almanac) to
+    the dates start to end, computing only the days previous does not
+    have and dropping the ones it no longer needs. bodies must be the ones
+    previous was computed for; the site, sun horizons and engine are
+    previous's, and previous must have been computed with the engine's
+    present settings. Every day is computed the same whatever range it is
+    computed in, so the result is identical to compute_almanac's.
+    '''
+    if bodies == None:
+        bodies = default_bodies ()
+    site = previous["site"]
+    sun_horizons = previous["sun_horizons"]
+    old = previous["times"]
+    keys = almanac_keys (bodies, sun_horizons)
+    if keys != old.keys:
+        raise ValueError ("previous almanac has events %s, not %s" % (
+                old.keys, keys))
+    engine = previous["engine"]
+    if previous["cached_engine"] != cached_engine (engine):
+        raise ValueError ("previous almanac was computed by %s, not %s" % (
+                previous["cached_engine"], cached_engine (engine)))
+    start_date, end_date = chart_dates (start, end, site.tzoffset)
+    days_in_chart = int (end_date - start_date + 0.5)
+    times = EventTimes (keys, days_in_chart)
+    # New day d is old day d + shift.
+    shift = int (round (start_date - previous["start_date"]))
+    keep_begin = min (max (0, -shift), days_in_chart)
+    keep_end = max (min (days_in_chart, len (old) - shift), keep_begin)
+    times.hours[:, keep_begin:keep_end] = old.hours[:,
+            keep_begin+shift:keep_end+shift]
+    for begin, end in ((0, keep_begin), (keep_end, days_in_chart)):
+        if begin < end:
+            where = site_observer (site)
+            where.date = start_date + begin
+            part = compute_times (where, end - begin, bodies, sun_horizons,
+                    engine, jobs, cache)
+            times.hours[:, begin:end] = part.hours
+    return dict (site=site, start_date=start_date, end_date=end_date,
+            days_in_chart=days_in_chart, sun_horizons=sun_horizons,
+            engine=engine, cached_engine=cached_engine (engine), times=times)
+
+def write_almanac (data, f):
+    '''Write the almanac data from compute_almanac to the binary file f,
+    for read_almanac.'''
+    header = dict (site=list (data["site"]),
+            start_date=float (data["start_date"]),
+            end_date=float (data["end_date"]),
+            sun_horizons=data["sun_horizons"], engine=data["engine"],
+            cached_engine=data["cached_engine"])
+    f.write (json.dumps (header).encode () + b"\n")
+    data["times"].write (f)
+
+def read_almanac (f):
+    '''Read almanac data written by write_almanac from the binary file f.'''
+    header = json.loads (f.readline ())
+    times = EventTimes.read (f)
+    return dict (site=Site (*header["site"]),
+            start_date=ephem.Date (header["start_date"]),
+            end_date=ephem.Date (header["end_date"]),
+            days_in_chart=len (times), sun_horizons=header["sun_horizons"],
+            engine=header["engine"],
+            cached_engine=header.get ("cached_engine"), times=times)
+
+# Engines precision_report compares with exact: the coarser precision
+# tiers and the default engine.
+check_engines = ["draft", "print", "vector"]
+# Latitudes precision_check also tries, in the site's hemisphere: twilight
+# and the moon graze the horizon there, which is hardest to get right.
+check_latitudes = [50, 55, 60, 65, 70]
+
+def precision_report (site, start = None, end = None, bodies = None,
+        sun_horizons = None, engines = None):
+    '''
+    Compute the almanac (as compute_almanac, without a cache) with the exact
+    tier's engine and with each of engines (default check_engines), each
+    from scratch.
+    Returns (seconds, deviations): seconds[engine] is how long each took,
+    and deviations[engine][(name, event)] is (max, rms, mismatched): the
+    largest and root mean square difference from exact in seconds, over
+    the days both have the event, and the number of days only one has it.
+    '''
+    if engines == None:
+        engines = check_engines
+    exact = precision_engines["exact"]
+    seconds = {}
+    times = {}
+    for engine in [exact] + [e for e in engines if e != exact]:
+        position_memo.clear ()
+        begin = time.perf_counter ()
+        times[engine] = compute_almanac (site, start, end, bodies,
+                sun_horizons, engine)["times"]
+        seconds[engine] = time.perf_counter () - begin
+    deviations = {}
+    for engine in engines:
+        deviations[engine] = {}
+        for key in times[exact].keys:
+            want = times[exact].row (*key)
+            got = times[engine].row (*key)
+            both = ~numpy.isnan (want) & ~numpy.isnan (got)
+            error = (got[both] - want[both]) * 3600
+            mismatched = int (numpy.count_nonzero (numpy.isnan (want)
+                    != numpy.isnan (got)))
+            if len (error):
+                deviations[engine][key] = (float (numpy.max (numpy.abs (error))),
+                        float (numpy.sqrt (numpy.mean (error ** 2))), mismatched)
+            else:
+                deviations[engine][key] = (0.0, 0.0, mismatched)
+    return seconds, deviations
+
+def print_precision_report (seconds, deviations, f = sys.stdout):
+    '''Print precision_report's results as a table, a column per engine.'''
+    engines = list (deviations)
+    print ("seconds from exact: max rms (days with the event in only one)",
+            file=f)
+    print ("%-12s %-10s" % ("body", "event")
+            + "".join ("  %-22s" % (engine,) for engine in engines), file=f)
+    for key in deviations[engines[0]]:
+        print ("%-12s %-10s" % key + "".join ("  %9.1f %7.1f %4d"
+                % deviations[engine][key] for engine in engines), file=f)
+    print ("%-23s" % ("time",) + "".join ("  %8.3fs %12s"
+            % (seconds[engine], "") for engine in engines), file=f)
+    exact = precision_engines["exact"]
+    print ("%-23s  %8.3fs" % ("time exact (%s)" % (exact,), seconds[exact]),
+            file=f)
+
+def precision_check (args):
+    '''
+    Print how far the event times of each precision tier, for the site,
+    dates and bodies in args (parsed command line arguments), are from
+    exact, and how long each took. Then the worst of each tier at each of
+    check_latitudes, with the site moved there.
+    '''
+    site = Site (args.latitude, args.longitude, args.elevation, args.tzoffset)
+    start_date, end_date = determine_start_and_end_dates (args)
+    bodies, plots = chart_bodies (args, site, start_date, end_date)
+    print_precision_report (*precision_report (site, start_date, end_date,
+            bodies, args.sun_horizons))
+    hemisphere = -1 if float (ephem.degrees (site.latitude)) < 0 else 1
+    print ()
+    print ("worst seconds from exact by latitude: max (days with the event in only one)")
+    print ("%-12s" % ("latitude",)
+            + "".join ("  %-14s" % (engine,) for engine in check_engines))
+    for latitude in check_latitudes:
+        moved = site._replace (latitude=str (hemisphere * latitude))
+        seconds, deviations = precision_report (moved, start_date,
+                end_date, bodies, args.sun_horizons)
+        print ("%-12s" % (moved.latitude,) + "".join ("  %9.1f %4d" % (
+                max (d[0] for d in deviations[engine].values ()),
+                sum (d[2] for d in deviations[engine].values ()))
+                for engine in check_engines))
+
+def chart_axes (data):
+    '''
+    Create the figure and axes for the almanac data returned by
+    compute_almanac: limits fitted to the night, with a border for labels,
+    and the date range written along the bottom.
+    Returns (fig, axes, start_plot_hour, end_plot_hour).
+    '''
+    import matplotlib.pyplot as plt
+    site = data["site"]
+    start_date, end_date = data["start_date"], data["end_date"]
+    days_in_chart = data["days_in_chart"]
+    times = data["times"]
+    mid_chart = int (days_in_chart / 2)  # only used for labelling
+
+    # These times should depend on extrema of sunrise and sunset times.
+    # Inside the polar circle the sun stays up or down all day on some
+    # days, and then the chart covers the whole day.
+    sun_set, sun_rise = times["sun"]["set"], times["sun"]["rise"]
+    # Start plot y axis this many hours after noon localtime (no DST adjustment)
+    if numpy.isnan (sun_set).any ():
+        start_plot_hour = 0
+    else:
+        start_plot_hour = math.floor (numpy.min (sun_set))
+    # End plot y axis this many hours after noon localtime (no DST adjustment)
+    if numpy.isnan (sun_rise).any ():
+        end_plot_hour = 24
+    else:
+        end_plot_hour = math.ceil (numpy.max (sun_rise))
+    if verbose:
+        print ("start_plot_hour = %s, end_plot_hour = %s" % (start_plot_hour, end_plot_hour))
+
+    fig = plt.figure()
+    axes = fig.add_axes([0.0, 0.0, 1.0, 1.0]) # left, bottom, width, height  range 0-1
+    axes.set_xlabel("Date")
+    axes.set_ylabel("hours after noon")
+
+    # Normally we'd want xlim from 0-days_in_chart and ylim from start_plot_hour-
+    # end_plot_hour. But we want some extra to fit labels.
+    extra_border_fraction = 0.05
+    extra_border_x = days_in_chart * extra_border_fraction
+    extra_border_y = (end_plot_hour - start_plot_hour) * extra_border_fraction
+    axes.set_xlim([0-extra_border_x,days_in_chart+extra_border_x])
+    axes.set_ylim([start_plot_hour-extra_border_y,end_plot_hour+extra_border_y])
+
+    # Put the date range on the chart.
+    date_label_x = mid_chart if float(site.latitude) > 0 else 0
+    axes.text (date_label_x, start_plot_hour-extra_border_y,
+            "%s - %s UTC%+d" % (
+                ephem.localtime (start_date).strftime ("%F"),
+                ephem.localtime (end_date).strftime ("%F"),
+                site.tzoffset),
+            va="bottom", ha="center")
+    return (fig, axes, start_plot_hour, end_plot_hour)
+
+def draw_events (axes, data, plots, layers = None):
+    '''
+    Draw the sun horizon curves of the almanac data and the events in
+    plots (a list like chart_plots), then place all their labels.
+    If layers is a dict, the sun horizons' artists, labels included, are
+    added to layers["sun"] and each body's to layers[its name].
+    '''
+    times = data["times"]
+    layout = LabelLayout (axes, data["days_in_chart"])
+    with chart_layer (layers, "sun", axes):
+        plot_object_event (axes, times, "sun", "set", layout, va="top")
+        plot_object_event (axes, times, "sun", "rise", layout, va="bottom")
+        plot_object_event (axes, times, "civil", "set", layout, label=None)
+        plot_object_event (axes, times, "civil", "rise", layout, label=None)
+        plot_object_event (axes, times, "nautical", "set", layout, label=None)
+        plot_object_event (axes, times, "nautical", "rise", layout, label=None)
+        plot_object_event (axes, times, "astro", "set", layout, label="evening twilight", va="top")
+        plot_object_event (axes, times, "astro", "rise", layout, label="morning twilight", va="bottom")
+        for name in data["sun_horizons"]:
+            if name in ("sun", "civil", "nautical", "astro"):
+                continue
+            plot_object_event (axes, times, name, "set", layout, label="%s set" % (name,), va="top")
+            plot_object_event (axes, times, name, "rise", layout, label="%s rise" % (name,), va="bottom")
+
+    #axes.plot (days, times["moon"]["rise"], 'y')
+    #axes.plot (days, times["moon"]["set"], 'g')
+
+    for name, event, kwargs in plots:
+        if name in times and event in times[name]:
+            with chart_layer (layers, name, axes):
+                plot_object_event (axes, times, name, event, layout, **kwargs)
+    with span ("label_layout", labels=len (layout.labels)):
+        layout.place ()
+    if layers != None:
+        for name, text in layout.texts:
+            layer = "sun" if name in data["sun_horizons"] else name
+            layers.setdefault (layer, []).append (text)
+
+    #axes.plot (days, times["polaris"]["antitransit"], 'k')
+    #axes.plot (days, times["polaris"]["transit"], 'k')
+
+@contextlib.contextmanager
+def chart_layer (layers, name, axes):
+    '''Add the artists drawn on axes in the with block to the list
+    layers[name], unless layers is None.'''
+    if layers == None:
+        yield
+        return
+    before = set (map (id, axes.get_children ()))
+    yield
+    layers.setdefault (name, []).extend (artist
+            for artist in axes.get_children () if not id (artist) in before)
+
+# The dot grids of draw_time_lines and draw_date_lines, thousands of tiny
+# markers, take most of the time to save a chart in a vector format. With
+# grid_dpi (--raster-grid) they are drawn instead as one image at grid_dpi,
+# which saves faster but prints as a bitmap. The last layer_cache_size
+# images are kept by what they depend on, so re-drawing the same dates with
+# other bodies or in another format (a --batch or --serve run) reuses them.
+# Raster formats draw the dots faster than they would scale an image.
+grid_dpi = None
+grid_image_formats = ["pdf", "svg", "eps", "ps"]
+layer_cache_size = 8
+layer_cache = collections.OrderedDict ()
+
+def grid_image (axes, start_hour, end_hour, days, times):
+    '''
+    The time_grid and date_grid of the chart on axes, as an RGBA image of
+    the axes at grid_dpi, from layer_cache or drawn.
+    '''
+    fig = axes.figure
+    bounds = axes.get_position ().bounds
+    inputs = json.dumps ([start_hour, end_hour, len (days),
+            list (axes.get_xlim ()), list (axes.get_ylim ()),
+            list (fig.get_size_inches ()), list (bounds), grid_dpi,
+            obcolor['fullgrid']]).encode ()
+    key = hashlib.sha1 (inputs + times["sun"]["rise"].tobytes ()
+            + times["sun"]["set"].tobytes ()).hexdigest ()
+    if key in layer_cache:
+        layer_cache.move_to_end (key)
+        count ("layer_cache_hits", "grid")
+        return layer_cache[key]
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    grid_fig = Figure (figsize=fig.get_size_inches () * bounds[2:],
+            dpi=grid_dpi)
+    canvas = FigureCanvasAgg (grid_fig)
+    grid_fig.patch.set_alpha (0)
+    grid_axes = grid_fig.add_axes ([0, 0, 1, 1])
+    grid_axes.set_xlim (axes.get_xlim ())
+    grid_axes.set_ylim (axes.get_ylim ())
+    grid_axes.set_axis_off ()
+    time_grid (start_hour, end_hour, days, grid_axes, times)
+    date_grid (start_hour, end_hour, days, grid_axes, times)
+    canvas.draw ()
+    image = numpy.array (canvas.buffer_rgba ())
+    layer_cache[key] = image
+    while len (layer_cache) > layer_cache_size:
+        layer_cache.popitem (last=False)
+    return image
+
+def draw_almanac (data, plots = None, grid_as_image = False):
+    '''
+    Draw the almanac data returned by compute_almanac (or almanac_page) on
+    a new figure.
+    plots is a list like chart_plots, which it defaults to.
+    grid_as_image draws the dot grids as one image (see grid_image) if
+    grid_dpi is set, for saving in a vector format.
+    Returns the matplotlib figure. Its almanac_layers maps "grid", "sun",
+    "moon" and each body's name to the artists drawn for them, so that
+    they can be hidden or shown again without drawing anything anew.
+    '''
+    if plots == None:
+        plots = chart_plots
+    times = data["times"]
+    days = range (data["days_in_chart"])
+    layers = {}
+    with span ("chart_axes"):
+        fig, axes, start_plot_hour, end_plot_hour = chart_axes (data)
+
+    grid_as_image = grid_as_image and grid_dpi != None
+    with chart_layer (layers, "grid", axes):
+        if grid_as_image:
+            with span ("grid_image"):
+                image = grid_image (axes, start_plot_hour, end_plot_hour,
+                        days, times)
+                limits = axes.axis ()
+                axes.imshow (image, extent=limits, aspect="auto",
+                        interpolation="antialiased")
+                axes.axis (limits)
+        with span ("draw_date_lines"):
+            draw_date_lines (start_plot_hour, end_plot_hour, days, axes,
+                    times, data["start_date"], grid=not grid_as_image)
+        with span ("draw_time_lines"):
+            draw_time_lines (start_plot_hour, end_plot_hour, days, axes,
+                    times, grid=not grid_as_image)
+    with span ("draw_events"):
+        draw_events (axes, data, plots, layers)
+
+    # When sun is down, plot moon rise time or set time with the phase of the
+    # moon at that moment.
+    if "moon" in times:
+        where = site_observer (data["site"])
+        where.date = data["start_date"]
+        with span ("plot_moon_phases"), chart_layer (layers, "moon", axes):
+            plot_moon_phases (axes, days, where, times)
+    fig.almanac_layers = layers
+    return fig
+
+def layer_toggles (fig):
+    '''
+    Check boxes along the right of fig, from draw_almanac, that hide and
+    show the sun horizons, the moon and each body.
+    Returns the CheckButtons, which must be kept for them to work.
+    '''
+    from matplotlib.widgets import CheckButtons
+    names = [name for name in fig.almanac_layers if name != "grid"]
+    box = fig.add_axes ([0.9, 0.5 - 0.0125 * len (names), 0.1,
+            0.025 * len (names)])
+    buttons = CheckButtons (box, names, [True] * len (names))
+    for text in buttons.labels:
+        text.set_fontsize (obfontsize['object'] + 2)
+    def toggle (name):
+        for artist in fig.almanac_layers[name]:
+            artist.set_visible (not artist.get_visible ())
+        fig.canvas.draw_idle ()
+    buttons.on_clicked (toggle)
+    return buttons
+
+def render_almanac (data, output = None, plots = None, format = None):
+    '''
+    Draw the almanac data returned by compute_almanac, then save it to the
+    file output, or show it if output is None.
+    plots is a list like chart_plots, which it defaults to.
+    format ("pdf", "png", ...) is needed when output is a file object.
+    Returns the matplotlib figure.
+    '''
+    import matplotlib.pyplot as plt
+    kind = format
+    if kind == None and isinstance (output, str):
+        kind = os.path.splitext (output)[1][1:].lower ()
+    fig = draw_almanac (data, plots, kind in grid_image_formats)
+    if output != None:
+        with span ("savefig", output=output):
+            fig.savefig (output, format=format)
+        plt.close (fig)
+    else:
+        toggles = layer_toggles (fig)
+        plt.show ()
+    return fig
+
+# Months per page for the named ways --pages splits a chart.
+page_months = {}
+page_months["halves"]   = 6
+page_months["quarters"] = 3
+page_months["months"]   = 1
+
+def page_dates (start_date, end_date, pages, tzoffset):
+    '''
+    Split the chart from start_date to end_date (local noon ephem.Dates)
+    into pages: pages is a key of page_months, for pages of that many
+    months from start_date (on the same day of the month, or the month's
+    last day if it is shorter), or comma separated dates on which new
+    pages start.
+    Returns a list of (start, end) local noon ephem.Dates.
+    '''
+    if pages in page_months:
+        year, month, day = start_date.tuple ()[:3]
+        starts = []
+        while True:
+            month += page_months[pages]
+            year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+            last = calendar.monthrange (year, month)[1]
+            starts.append (normalize_to_noon (ephem.Date ((year, month,
+                    min (day, last))), tzoffset))
+            if starts[-1] >= end_date:
+                break
+    else:
+        starts = [normalize_to_noon (ephem.Date (date.strip ()), tzoffset)
+                for date in pages.split (",")]
+    edges = sorted (set ([start_date, end_date]
+            + [t for t in starts if start_date < t < end_date]))
+    return [(ephem.Date (a), ephem.Date (b)) for a, b in zip (edges, edges[1:])]
+
+def almanac_page (data, start, end):
+    '''
+    The days of the almanac data from start to end (local noon
+    ephem.Dates within its range) as almanac data of their own, sharing
+    data's event times rather than copying them.
+    '''
+    begin = int (start - data["start_date"] + 0.5)
+    stop = int (end - data["start_date"] + 0.5)
+    times = data["times"]
+    page = dict (data)
+    page.update (start_date=start, end_date=end, days_in_chart=stop - begin,
+            times=EventTimes (times.keys, stop - begin,
+                times.hours[:, begin:stop]))
+    return page
+
+def page_file (output, n):
+    '''The file for page n (from 1) when each page has its own:
+    output with -n before its extension.'''
+    name, extension = os.path.splitext (output)
+    return "%s-%d%s" % (name, n, extension)
+
+def page_job (page, plots, output, grid_as_image = False):
+    '''
+    Process pool entry point for render_pages: draw the page (as from
+    almanac_page) and save it to output, or, if that is None, return the
+    figure, drawn with grid_as_image as for draw_almanac.
+    '''
+    if output == None:
+        return draw_almanac (page, plots, grid_as_image)
+    render_almanac (page, output, plots)
+    return output
+
+def render_pages (data, pages, output = None, plots = None, separate = False,
+        jobs = 1):
+    '''
+    Draw the almanac data returned by compute_almanac as a page for each
+    (start, end) in pages (as from page_dates), without computing anything
+    again. The pages go in one multi-page PDF, output, or, if separate,
+    each in its own file (page_file); if output is None they are shown.
+    With jobs > 1 the pages are drawn by a pool of worker processes.
+    '''
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+    pieces = [almanac_page (data, start, end) for start, end in pages]
+    outputs = [page_file (output, n + 1) if separate and output != None
+            else None for n in range (len (pieces))]
+    with span ("render_pages", pages=len (pieces), jobs=jobs):
+        if jobs > 1 and len (pieces) > 1:
+            with process_pool (jobs) as pool:
+                futures = [pool.submit (page_job, page, plots, file,
+                        output != None) for page, file in zip (pieces, outputs)]
+                results = [future.result () for future in futures]
+        else:
+            results = [page_job (page, plots, file, output != None)
+                    for page, file in zip (pieces, outputs)]
+    if separate and output != None:
+        return
+    if output == None:
+        plt.show ()
+        return
+    with span ("savefig", output=output):
+        with PdfPages (output) as pdf:
+            for fig in results:
+                pdf.savefig (fig)
+                plt.close (fig)
+
+# Fields of an exported event record, in order.
+export_fields = ["day", "body", "event", "hours", "utc", "sun_masked"]
+
+# Days computed at a time when exporting; memory use depends on this, not
+# on the length of the date range.
+export_chunk_days = 366
+
+def event_records (site = Site (), start = None, end = None, bodies = None,
+        sun_horizons = None, engine = 'vector', jobs = 1, cache = None):
+    '''
+    Generate one dict per event, with the keys in export_fields, for the
+    same almanac as compute_almanac (which see for the arguments), in date
+    order, without keeping more than export_chunk_days of it at a time.
+    day is the local date of the chart day, hours are after its local noon,
+    utc is the moment of the event, and sun_masked says the sun is up then
+    (never for the sun horizons). Events that do not happen are left out.
+    '''
+    if bodies == None:
+        bodies = default_bodies ()
+    if sun_horizons == None:
+        sun_horizons = default_sun_horizons
+    where = site_observer (site)
+    start_date, end_date = chart_dates (start, end, site.tzoffset)
+    days_in_chart = int (end_date - start_date + 0.5)
+    requests = [(ephem.Sun(), list (sun_horizons.values ()),
+            (True, True, False, False))]
+    for object, name, kwargs in bodies:
+        requests.append ((object, [kwargs.get ("horizon", '0')],
+                (kwargs.get ("do_rise", True), kwargs.get ("do_set", True),
+                kwargs.get ("do_transit", True),
+                kwargs.get ("do_anti_transit", False))))
+    for chunk in range (0, days_in_chart, export_chunk_days):
+        first = start_date + chunk
+        day_count = min (export_chunk_days, days_in_chart - chunk)
+        results = compute_event_hours_many (requests, where, first,
+                day_count, engine, jobs, cache)
+        forget_positions (first)
+        sun = results[0][sun_horizons["sun"]]
+        for i in range (day_count):
+            noon = first + i
+            day = ephem.Date (noon + site.tzoffset * ephem.hour).datetime ().date ().isoformat ()
+            for name, horizon in sun_horizons.items ():
+                for event in ("set", "rise"):
+                    yield from event_record (day, noon, name, event,
+                            results[0][horizon][event][i], False)
+            for (object, name, kwargs), (_, horizons, _), hours in zip (
+                    bodies, requests[1:], results[1:]):
+                for event in event_search:
+                    if event in hours[horizons[0]]:
+                        h = hours[horizons[0]][event][i]
+                        yield from event_record (day, noon, name, event, h,
+                                bool (h > sun["rise"][i] or h < sun["set"][i]))
+
+def event_record (day, noon, name, event, hours, sun_masked):
+    '''The event record for event_records, if the event happens.'''
+    if math.isnan (hours):
+        return
+    utc = ephem.Date (noon + hours * ephem.hour).datetime ()
+    yield dict (day=day, body=name, event=event, hours=round (float (hours), 6),
+            utc=utc.strftime ("%Y-%m-%dT%H:%M:%SZ"), sun_masked=sun_masked)
+
+def export_csv (records, output):
+    '''Write event records to the file output as CSV with a header row.'''
+    writer = csv.DictWriter (output, export_fields)
+    writer.writeheader ()
+    for record in records:
+        writer.writerow (record)
+
+def export_jsonl (records, output):
+    '''Write event records to the file output as JSON Lines.'''
+    for record in records:
+        output.write (json.dumps (record) + "\n")
+
+# Rows per Parquet row group.
+parquet_batch_rows = 65536
+
+def export_parquet (records, path):
+    '''
+    Write event records to a Parquet file at path, a row group at a time.
+    Needs pyarrow.
+    '''
+    import pyarrow
+    import pyarrow.parquet
+    schema = pyarrow.schema ([("day", pyarrow.string ()),
+            ("body", pyarrow.string ()), ("event", pyarrow.string ()),
+            ("hours", pyarrow.float64 ()), ("utc", pyarrow.string ()),
+            ("sun_masked", pyarrow.bool_ ())])
+    with pyarrow.parquet.ParquetWriter (path, schema) as writer:
+        batch = []
+        for record in records:
+            batch.append (record)
+            if len (batch) == parquet_batch_rows:
+                writer.write_table (pyarrow.Table.from_pylist (batch, schema))
+                batch = []
+        if batch:
+            writer.write_table (pyarrow.Table.from_pylist (batch, schema))
+
+# Export formats: (writer, file name extension, whether it writes text).
+export_formats = {}
+export_formats["csv"]     = (export_csv, ".csv", True)
+export_formats["jsonl"]   = (export_jsonl, ".jsonl", True)
+export_formats["parquet"] = (export_parquet, ".parquet", False)
+
+def export (args):
+    '''
+    Stream the event times for the site and dates in args (parsed command
+    line arguments) to args.output_file, or standard output, in the
+    args.export format, without drawing anything.
+    '''
+    site = Site (args.latitude, args.longitude, args.elevation, args.tzoffset)
+    start_date, end_date = determine_start_and_end_dates (args)
+    bodies, plots = chart_bodies (args, site, start_date, end_date)
+    records = event_records (site, start_date, end_date, bodies,
+            sun_horizons=args.sun_horizons, engine=args.engine,
+            jobs=args.jobs, cache=open_event_cache (args))
+    writer, extension, text = export_formats[args.export]
+    if not text:
+        writer (records, args.output_file)
+    elif args.output_file == None:
+        writer (records, sys.stdout)
+    else:
+        with open (args.output_file, "w", newline='') as output:
+            writer (records, output)
+
+def ephemeris_path (args):
+    '''The ephemeris table file selected on the command line.'''
+    if args.ephemeris != None:
+        return args.ephemeris
+    return os.path.join (args.cache_dir, "ephemeris.bin")
+
+def open_ephemeris_table (path):
+    '''The EphemerisTable at path, or None if it was made by another
+    version of pyephem, whose positions could differ.'''
+    table = EphemerisTable (path)
+    if table.ephem != ephem.__version__:
+        print ("%s: made with pyephem %s, not %s; not using it" % (path,
+                table.ephem, ephem.__version__))
+        return None
+    return table
+
+def build_ephemeris (args):
+    '''Write the ephemeris table for --build-ephemeris.'''
+    path = ephemeris_path (args)
+    first = ephem.Date (args.start_date or ephemeris_span[0])
+    last = ephem.Date (args.end_date or ephemeris_span[1])
+    os.makedirs (os.path.dirname (path) or '.', exist_ok=True)
+    # Processes may have the old table mapped; replace it rather than
+    # writing over it.
+    with open (path + ".new", "wb") as f:
+        write_ephemeris_table (f, first, last)
+    os.replace (path + ".new", path)
+    print ("%s: %s to %s, %.1f MB" % (path, first, last,
+            os.path.getsize (path) / 1e6), end=' ')
+    show_elapsed_time()
+
+def open_event_cache (args):
+    '''The event cache selected on the command line, or None.'''
+    if args.no_cache:
+        return None
+    return EventCache (os.path.join (args.cache_dir, "events.sqlite"),
+            args.cache_size * 1024 * 1024)
+
+def sun_horizons_from_args (args, parser):
+    '''default_sun_horizons plus any --sun-horizon NAME=DEGREES. Each
+    name gets rows of its own in the event times, so it must not be one
+    already used, by another horizon or by a charted body.'''
+    sun_horizons = dict (default_sun_horizons)
+    body_names = [name for object, name, kwargs in default_bodies ()]
+    for spec in args.sun_horizon:
+        name, _, horizon = spec.partition ('=')
+        if not name or not horizon:
+            parser.error ("--sun-horizon expects NAME=DEGREES, not %r" % (spec,))
+        try:
+            degrees = float (ephem.degrees (horizon))
+        except ValueError:
+            degrees = math.nan
+        if not abs (degrees) <= math.pi / 2:
+            parser.error ("--sun-horizon %s: %r is not an altitude in degrees"
+                    % (name, horizon))
+        if name in sun_horizons:
+            parser.error ("--sun-horizon %s: there is already a sun horizon called %s"
+                    % (name, name))
+        if name in body_names:
+            parser.error ("--sun-horizon %s: %s is a charted body" % (name, name))
+        sun_horizons[name] = horizon
+    return sun_horizons
+
+def chart_bodies (args, site, start_date, end_date):
+    '''
+    The bodies (like default_bodies ()) and plots (like chart_plots) to
+    chart for args (parsed command line arguments): the defaults, plus the
+    transits of the bodies in the args.catalog files that are no fainter
+    than args.max_magnitude and that site sees transit at night on some
+    day from start_date to end_date (ephem.Dates).
+    '''
+    bodies = default_bodies ()
+    plots = list (chart_plots)
+    if not args.catalog:
+        return bodies, plots
+    catalog = []
+    for path in args.catalog:
+        catalog += load_catalog (path)
+    with span ("catalog_index", bodies=len (catalog)):
+        index = CatalogIndex (catalog, start_date, end_date)
+    with span ("catalog_visible", bodies=len (catalog)):
+        visible = index.visible (site_observer (site), start_date,
+                int (end_date - start_date + 0.5),
+                max_magnitude=args.max_magnitude)
+    names = set (name for object, name, kwargs in bodies)
+    for object in visible:
+        if object.name in names:
+            continue
+        names.add (object.name)
+        bodies.append ((object, object.name, dict (do_rise=False, do_set=False)))
+        plots.append ((object.name, "transit", {}))
+    return bodies, plots
+
+def almanac (args):
+    '''
+    Compute and draw the almanac for the site and dates in args (parsed
+    command line arguments), then save or show it.
+    '''
+    site = Site (args.latitude, args.longitude, args.elevation, args.tzoffset)
+    start_date, end_date = determine_start_and_end_dates (args)
+    print ("start date: %s" % (start_date,))
+    print ("end date: %s" % (end_date,))
+    if args.verbose:
+        print ("start %s, end %s, %s, %s  %3.0fm" % (start_date, end_date,
+            args.longitude, args.latitude, args.elevation))
+        print ("start_date = %s, end_date = %s" % (
+            ephem.Date(start_date), ephem.Date(end_date), ))
+
+    bodies, plots = chart_bodies (args, site, start_date, end_date)
+    if args.catalog:
+        print ("%d catalog bodies" % (len (bodies) - len (default_bodies ()),),
+                end=' ')
+        show_elapsed_time()
+    cache = open_event_cache (args)
+    data = None
+    if args.snapshot != None and os.path.exists (args.snapshot):
+        with open (args.snapshot, "rb") as f:
+            previous = read_almanac (f)
+        if (previous["site"] == site
+                and previous["cached_engine"] == cached_engine (args.engine)
+                and previous["sun_horizons"] == args.sun_horizons):
+            try:
+                data = update_almanac (previous, start_date, end_date,
+                        bodies, jobs=args.jobs, cache=cache)
+            except ValueError:
+                pass    # different bodies; start over
+    if data == None:
+        data = compute_almanac (site, start_date, end_date, bodies,
+                sun_horizons=args.sun_horizons, engine=args.engine,
+                jobs=args.jobs, cache=cache)
+    if args.snapshot != None:
+        # Replace the old snapshot only once the new one is complete.
+        with open (args.snapshot + ".new", "wb") as f:
+            write_almanac (data, f)
+        os.replace (args.snapshot + ".new", args.snapshot)
+    if args.pages != None:
+        render_pages (data, page_dates (start_date, end_date, args.pages,
+                args.tzoffset), args.output_file, plots, args.page_files,
+                args.jobs)
+    else:
+        render_almanac (data, args.output_file, plots)
+
+# Per-site settings a batch site list may give, and how to read them.
+site_fields = {}
+site_fields["name"]        = str
+site_fields["latitude"]    = str
+site_fields["longitude"]   = str
+site_fields["elevation"]   = float
+site_fields["tzoffset"]    = int
+site_fields["start_date"]  = str
+site_fields["end_date"]    = str
+site_fields["output_file"] = str
+site_fields["snapshot"]    = str
+
+def read_sites (path, defaults):
+    '''
+    Read a batch site list: CSV with a header row, or a JSON list of
+    objects, with the keys in site_fields. Anything a site leaves out comes
+    from defaults (the command line arguments); output_file defaults to
+    NAME.pdf, or NAME with the extension of the --export format.
+    Returns a list of argparse.Namespace, one per site.
+    '''
+    with open (path, newline='') as f:
+        if path.endswith ('.json'):
+            rows = json.load (f)
+        else:
+            rows = list (csv.DictReader (f))
+    sites = []
+    for n, row in enumerate (rows):
+        site = argparse.Namespace (**vars (defaults))
+        site.name = "site%d" % (n+1,)
+        # Sites cannot share a snapshot.
+        site.snapshot = None
+        for key, value in row.items ():
+            if not key in site_fields:
+                raise ValueError ("%s: unknown site field %r" % (path, key))
+            if value != None and value != '':
+                setattr (site, key, site_fields[key] (value))
+        if not "output_file" in row or not row["output_file"]:
+            if defaults.export != None:
+                site.output_file = site.name + export_formats[defaults.export][1]
+            else:
+                site.output_file = site.name + ".pdf"
+        sites.append (site)
+    return sites
+
+def prefetch_positions (sites):
+    '''
+    Sample the geocentric positions of the sun and default_bodies over
+    every site's date range, so that sites (and forked workers) share them.
+    '''
+    ranges = [determine_start_and_end_dates (site) for site in sites]
+    first = min (start for start, end in ranges)
+    last = max (end for start, end in ranges) + 1
+    where = ephem.Observer ()
+    for object in [ephem.Sun()] + [body[0] for body in default_bodies ()]:
+        sample_positions (object, where, first, last, choose_knot_step (object))
+
+def almanac_job (site):
+    '''
+    Draw one site's almanac, catching any failure.
+    Returns wall and CPU seconds, and the error message or None.
+    '''
+    wall, cpu = time.perf_counter (), time.process_time ()
+    try:
+        if site.export != None:
+            export (site)
+        else:
+            almanac (site)
+        error = None
+    except Exception as e:
+        error = "%s: %s" % (type (e).__name__, e)
+    return (time.perf_counter () - wall, time.process_time () - cpu, error)
+
+def batch (args):
+    '''
+    Draw the almanac of every site in the args.batch site list in this one
+    process, args.jobs sites at a time, then print how long each took.
+    '''
+    start = time.perf_counter ()
+    sites = read_sites (args.batch, args)
+    prefetch_positions (sites)
+    if args.jobs > 1 and len (sites) > 1:
+        # Sites run in parallel, so each computes its own events serially.
+        for site in sites:
+            site.jobs = 1
+        with process_pool (args.jobs) as pool:
+            futures = [pool.submit (almanac_job, site) for site in sites]
+            timings = [future.result () for future in futures]
+    else:
+        timings = [almanac_job (site) for site in sites]
+    print ("%-20s %8s %8s  %s" % ("site", "wall", "cpu", "output"))
+    for site, (wall, cpu, error) in zip (sites, timings):
+        print ("%-20s %8.2f %8.2f  %s" % (site.name, wall, cpu,
+                site.output_file if error == None else "FAILED " + error))
+    print ("%d sites in %.2f seconds" % (len (sites),
+            time.perf_counter () - start))
+
+# The render service: almanac parameters a request may give, the number of
+# computed almanacs kept in memory, and the formats it draws.
+service_fields = ["latitude", "longitude", "elevation", "tzoffset",
+        "start_date", "end_date"]
+service_almanacs = 32
+service_max_days = 5 * 366     # longest chart a request may ask for
+service_max_tzoffset = 14      # hours, as far as time zones go
+service_formats = {}
+service_formats["pdf"]  = "application/pdf"
+service_formats["png"]  = "image/png"
+service_formats["json"] = "application/json"
+http_reasons = {200: "OK", 400: "Bad Request", 404: "Not Found",
+        405: "Method Not Allowed", 500: "Internal Server Error"}
+
+def service_compute_job (args):
+    '''
+    Process pool entry point for the render service: compute the almanac
+    for the site and dates in args (as almanac would).
+    Returns (data, plots), as from compute_almanac and chart_bodies.
+    '''
+    site = Site (args.latitude, args.longitude, args.elevation, args.tzoffset)
+    start_date, end_date = determine_start_and_end_dates (args)
+    bodies, plots = chart_bodies (args, site, start_date, end_date)
+    data = compute_almanac (site, start_date, end_date, bodies,
+            sun_horizons=args.sun_horizons, engine=args.engine,
+            cache=open_event_cache (args))
+    return data, plots
+
+def service_render_job (data, plots, format):
+    '''
+    Process pool entry point for the render service: the almanac data
+    drawn as format, a key of service_formats, as bytes. json is the event
+    times, by name and event, with null where there is no event.
+    '''
+    if format == "json":
+        times = data["times"]
+        return json.dumps (dict (site=data["site"]._asdict (),
+                start_date=str (data["start_date"]),
+                end_date=str (data["end_date"]),
+                times={name: {event: [None if math.isnan (h) else round (h, 6)
+                    for h in hours.tolist ()]
+                    for event, hours in times[name].items ()}
+                    for name in times})).encode ()
+    import matplotlib
+    matplotlib.use ("Agg")
+    output = io.BytesIO ()
+    render_almanac (data, output, plots, format)
+    return output.getvalue ()
+
+class AlmanacService:
+    '''
+    HTTP requests for almanacs, computed and drawn in pool (a process pool).
+    Computed almanacs are kept, most recently used first, up to
+    service_almanacs of them, and requests arriving while an identical one
+    is being computed or drawn wait for its result instead of repeating it.
+    '''
+    def __init__ (self, args, pool):
+        self.args = args
+        self.pool = pool
+        # (site, start, end) -> (data, plots), least recently used first.
+        self.almanacs = collections.OrderedDict ()
+        # Key -> task computing it.
+        self.pending = {}
+
+    async def shared (self, key, make):
+        '''The result of the coroutine make (), shared by every request
+        for key made while it runs.'''
+        task = self.pending.get (key)
+        if task == None:
+            task = asyncio.ensure_future (make ())
+            self.pending[key] = task
+            task.add_done_callback (lambda task: self.pending.pop (key, None))
+        # A client going away must not cancel the others' result.
+        return await asyncio.shield (task)
+
+    def request_args (self, query):
+        '''The command line arguments with the site and dates of query
+        (from urllib.parse.parse_qs). Raises ValueError for bad ones.'''
+        args = argparse.Namespace (**vars (self.args))
+        for key, values in query.items ():
+            if not key in service_fields:
+                raise ValueError ("unknown parameter %r" % (key,))
+            setattr (args, key, site_fields[key] (values[-1]))
+        # Check them here rather than in a worker.
+        if not abs (float (ephem.degrees (args.latitude))) <= math.pi / 2:
+            raise ValueError ("latitude must be within 90 degrees of 0")
+        if not abs (float (ephem.degrees (args.longitude))) <= math.pi:
+            raise ValueError ("longitude must be within 180 degrees of 0")
+        if not math.isfinite (args.elevation):
+            raise ValueError ("elevation must be a number of meters")
+        if not abs (args.tzoffset) <= service_max_tzoffset:
+            raise ValueError ("tzoffset must be within %d hours of 0"
+                    % (service_max_tzoffset,))
+        start_date, end_date = determine_start_and_end_dates (args)
+        if end_date <= start_date:
+            raise ValueError ("end_date is not after start_date")
+        if end_date - start_date > service_max_days:
+            raise ValueError ("at most %d days from start_date to end_date"
+                    % (service_max_days,))
+        return args
+
+    async def almanac (self, args):
+        '''The (data, plots) for args, from memory or computed.'''
+        key = (Site (args.latitude, args.longitude, args.elevation,
+                args.tzoffset),) + tuple (map (float,
+                determine_start_and_end_dates (args)))
+        if key in self.almanacs:
+            self.almanacs.move_to_end (key)
+            return self.almanacs[key]
+        async def compute ():
+            result = await asyncio.get_running_loop ().run_in_executor (
+                    self.pool, service_compute_job, args)
+            self.almanacs[key] = result
+            while len (self.almanacs) > service_almanacs:
+                self.almanacs.popitem (last=False)
+            return result
+        return await self.shared (("almanac",) + key, compute)
+
+    async def render (self, format, query, args):
+        '''The almanac for query, with args from request_args, drawn as
+        format.'''
+        async def draw ():
+            data, plots = await self.almanac (args)
+            return await asyncio.get_running_loop ().run_in_executor (
+                    self.pool, service_render_job, data, plots, format)
+        return await self.shared (("render", format,
+                tuple (sorted ((k, v[-1]) for k, v in query.items ()))), draw)
+
+    async def handle (self, reader, writer):
+        '''Answer one HTTP request, then close the connection.'''
+        try:
+            request = (await reader.readline ()).decode ("latin-1").split ()
+            while (await reader.readline ()) not in (b"\r\n", b"\n", b""):
+                pass
+            status, body, content_type = 200, b"", "text/plain"
+            if len (request) != 3 or request[0] not in ("GET", "HEAD"):
+                status, body = 405, b"only GET and HEAD\n"
+            else:
+                url = urllib.parse.urlsplit (request[1])
+                name, _, format = url.path.rpartition (".")
+                if name != "/almanac" or not format in service_formats:
+                    status, body = 404, ("try /almanac.pdf, /almanac.png "
+                            "or /almanac.json\n").encode ()
+                else:
+                    query = urllib.parse.parse_qs (url.query)
+                    try:
+                        args = self.request_args (query)
+                    except ValueError as e:
+                        status, body = 400, ("%s\n" % (e,)).encode ()
+                    else:
+                        # Anything going wrong from here on is ours.
+                        try:
+                            body = await self.render (format, query, args)
+                            content_type = service_formats[format]
+                        except Exception as e:
+                            status, body = 500, ("%s: %s\n" % (
+                                    type (e).__name__, e)).encode ()
+            writer.write (("HTTP/1.1 %d %s\r\nContent-Type: %s\r\n"
+                    "Content-Length: %d\r\nConnection: close\r\n\r\n" % (
+                    status, http_reasons[status], content_type,
+                    len (body))).encode ())
+            if request[:1] != ["HEAD"]:
+                writer.write (body)
+            await writer.drain ()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close ()
+
+def serve (args):
+    '''Run the render service on localhost port args.serve until
+    interrupted or sent SIGTERM.'''
+    async def run (pool):
+        service = AlmanacService (args, pool)
+        server = await asyncio.start_server (service.handle, "127.0.0.1",
+                args.serve)
+        stop = asyncio.Event ()
+        try:
+            asyncio.get_running_loop ().add_signal_handler (signal.SIGTERM,
+                    stop.set)
+        except (NotImplementedError, AttributeError):
+            pass    # No SIGTERM handlers on Windows.
+        print ("serving almanacs on http://127.0.0.1:%d/almanac.pdf" % (
+                args.serve,), flush=True)
+        async with server:
+            await stop.wait ()
+    with process_pool (max (1, args.jobs)) as pool:
+        try:
+            asyncio.run (run (pool))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Leaving the with waits for the workers; give them nothing
+            # more to do first.
+            pool.shutdown (wait=False, cancel_futures=True)
+
+def main (argv = None):
+    '''The command line program.'''
+    parser = make_parser ()
+    args = parser.parse_args (argv)
+    args.sun_horizons = sun_horizons_from_args (args, parser)
+    if args.precision != None:
+        if args.engine != None:
+            parser.error ("--precision and --engine cannot both be given")
+        args.engine = precision_engines[args.precision]
+    elif args.engine == None:
+        args.engine = 'vector'
+    if (args.export != None and not export_formats[args.export][2]
+            and args.output_file == None and args.batch == None):
+        parser.error ("--export %s needs --output-file" % (args.export,))
+    if (args.pages != None and not args.page_files and args.output_file != None
+            and not args.output_file.endswith (".pdf")):
+        parser.error ("--pages in one file needs a .pdf OUTPUT_FILE; use --page-files for others")
+    if args.export == "parquet" and importlib.util.find_spec ("pyarrow") == None:
+        parser.error ("--export parquet needs pyarrow")
+    for path in args.catalog:
+        try:
+            loaded_catalogs[path] = load_catalog (path)
+        except OSError as e:
+            parser.error ("--catalog %s: %s" % (path, e.strerror))
+        except UnicodeDecodeError:
+            parser.error ("--catalog %s: not a text file" % (path,))
+        except ValueError as e:
+            parser.error ("--catalog %s" % (e,))
+    global tracing, adaptive_tolerance, ephemeris_table, grid_dpi
+    global verbose
+    verbose = bool (args.verbose)
+    grid_dpi = args.raster_grid
+    if args.clear_cache and not args.no_cache:
+        open_event_cache (args).clear ()
+    adaptive_tolerance = args.adaptive_tolerance
+    if args.build_ephemeris:
+        build_ephemeris (args)
+        return
+    if os.path.exists (ephemeris_path (args)):
+        ephemeris_table = open_ephemeris_table (ephemeris_path (args))
+    if args.profile != None:
+        tracing = Trace (args.profile_memory)
+    if args.profile_python != None:
+        profile = cProfile.Profile ()
+        profile.enable ()
+    try:
+        with span ("main"):
+            if args.serve != None:
+                serve (args)
+            elif args.batch != None:
+                batch (args)
+            elif args.export != None:
+                export (args)
+            elif args.precision_check:
+                precision_check (args)
+            else:
+                almanac (args)
+    finally:
+        if args.profile_python != None:
+            profile.disable ()
+            profile.dump_stats (args.profile_python)
+        if tracing != None:
+            tracing.write (args.profile)
+            tracing = None
 
+if __name__ == "__main__":
+    main ()
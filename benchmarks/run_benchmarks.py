@@ -0,0 +1,431 @@
+#!/usr/bin/python3
+'''
+Benchmarks for astroalmanac: event computation by body type, chart length
+and latitude, precision at high latitudes, and each rendering stage.
+
+    python3 benchmarks/run_benchmarks.py --save results.json
+    python3 benchmarks/run_benchmarks.py --compare results.json
+
+Each benchmark is timed --repeat times, best and median kept. Results are
+saved as JSON; --compare reports the ratio of every benchmark to a saved
+baseline and exits with status 1 if any got slower than --threshold.
+'''
+import argparse
+import atexit
+import io
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+import ephem
+import matplotlib
+matplotlib.use ("Agg")
+import matplotlib.pyplot as plt
+import numpy
+
+import astroalmanac
+
+# Benchmarks in the order they run: name -> (setup, run).
+# setup () returns the state passed to run (state); only run is timed.
+benchmarks = {}
+
+def benchmark (name, setup, run):
+    benchmarks[name] = (setup, run)
+
+def fresh_start ():
+    '''Forget remembered positions, so each run computes from scratch as a
+    new process would.'''
+    astroalmanac.position_memo.clear ()
+
+# rise_set_transit by body type, one year, each engine.
+body_types = {}
+body_types["sun"]           = ephem.Sun
+body_types["moon"]          = ephem.Moon
+body_types["inner_planet"]  = ephem.Mercury
+body_types["outer_planet"]  = ephem.Jupiter
+body_types["fixed_star"]    = lambda: ephem.star ("Sirius")
+
+def rise_set_transit_setup (engine, make_body):
+    def setup ():
+        fresh_start ()
+        site = astroalmanac.Site ()
+        where = astroalmanac.site_observer (site)
+        where.date, end = astroalmanac.chart_dates ('2024', '2025', site.tzoffset)
+        day_count = int (end - where.date + 0.5)
+        object = make_body ()
+        name = "sun" if isinstance (object, ephem.Sun) else "body"
+        times = astroalmanac.EventTimes ([("sun", "set"), ("sun", "rise")]
+                + [(name, "transit")] + ([] if name == "sun" else
+                    [("body", "set"), ("body", "rise")]), day_count)
+        return (object, name, where, times, day_count, engine)
+    return setup
+
+def rise_set_transit_run (state):
+    object, name, where, times, day_count, engine = state
+    astroalmanac.rise_set_transit (object, name, where, times,
+            day_count, engine=engine)
+
+for engine in ("vector", "pyephem", "adaptive"):
+    for body_type, make_body in body_types.items ():
+        benchmark ("rise_set_transit.%s.%s" % (engine, body_type),
+                rise_set_transit_setup (engine, make_body),
+                rise_set_transit_run)
+
+# Whole almanac computation by chart length.
+chart_lengths = {}
+chart_lengths["1_month"]  = ('2024/1/1', '2024/2/1')
+chart_lengths["6_months"] = ('2024/1/1', '2024/7/1')
+chart_lengths["1_year"]   = ('2024/1/1', '2025/1/1')
+chart_lengths["5_years"]  = ('2024/1/1', '2029/1/1')
+
+def compute_setup (site, start, end, engine):
+    def setup ():
+        fresh_start ()
+        return (site, start, end, engine)
+    return setup
+
+def compute_run (state):
+    site, start, end, engine = state
+    astroalmanac.compute_almanac (site, start, end, engine=engine)
+
+for length, (start, end) in chart_lengths.items ():
+    benchmark ("days_in_chart.vector.%s" % (length,),
+            compute_setup (astroalmanac.Site (), start, end, "vector"),
+            compute_run)
+for tier in ("draft", "print"):
+    benchmark ("days_in_chart.%s.1_year" % (tier,),
+            compute_setup (astroalmanac.Site (), *chart_lengths["1_year"],
+                astroalmanac.precision_engines[tier]), compute_run)
+benchmark ("days_in_chart.pyephem.1_month",
+        compute_setup (astroalmanac.Site (), *chart_lengths["1_month"],
+            "pyephem"), compute_run)
+
+# The one year chart again, with positions looked up in an ephemeris table.
+ephemeris_file = []
+
+def ephemeris_setup ():
+    fresh_start ()
+    if not ephemeris_file:
+        f = tempfile.NamedTemporaryFile (suffix=".bin", delete=False)
+        with f:
+            astroalmanac.write_ephemeris_table (f, ephem.Date ('2023/12/1'),
+                    ephem.Date ('2025/2/1'))
+        atexit.register (os.remove, f.name)
+        ephemeris_file.append (f.name)
+    return (astroalmanac.Site (), '2024/1/1', '2025/1/1', "vector")
+
+def ephemeris_run (state):
+    astroalmanac.ephemeris_table = astroalmanac.EphemerisTable (ephemeris_file[0])
+    try:
+        compute_run (state)
+    finally:
+        astroalmanac.ephemeris_table = None
+
+benchmark ("days_in_chart.vector.1_year_ephemeris_table", ephemeris_setup,
+        ephemeris_run)
+
+# Latitudes around where astronomical twilight stops happening in summer.
+latitudes = ['40', '45', '48', '50', '55', '60', '65', '70']
+
+for latitude in latitudes:
+    site = astroalmanac.Site (latitude=latitude, longitude='0', elevation=0,
+            tzoffset=0)
+    benchmark ("latitude.vector.%s" % (latitude,),
+            compute_setup (site, '2024/1/1', '2025/1/1', "vector"),
+            compute_run)
+    benchmark ("latitude.pyephem.%s" % (latitude,),
+            compute_setup (site, '2024/6/1', '2024/7/1', "pyephem"),
+            compute_run)
+
+# How far the vector engine is from the exact tier at high latitudes, where
+# twilight and the moon graze the horizon. run returns the largest
+# difference in seconds, which is kept alongside the time.
+exact_times = {}
+
+def precision_setup (site):
+    def setup ():
+        fresh_start ()
+        if site not in exact_times:
+            exact_times[site] = astroalmanac.compute_almanac (site,
+                    '2024/1/1', '2025/1/1',
+                    engine=astroalmanac.precision_engines["exact"])["times"]
+        return site
+    return setup
+
+def precision_run (site):
+    times = astroalmanac.compute_almanac (site, '2024/1/1',
+            '2025/1/1', engine="vector")["times"]
+    worst = 0.0
+    for key in times.keys:
+        want = exact_times[site].row (*key)
+        got = times.row (*key)
+        both = ~numpy.isnan (want) & ~numpy.isnan (got)
+        if both.any ():
+            worst = max (worst, float (numpy.max (numpy.abs (got[both]
+                    - want[both]))) * 3600)
+    return worst
+
+for latitude in latitudes:
+    if float (latitude) >= 50:
+        benchmark ("precision.vector.%s" % (latitude,),
+                precision_setup (astroalmanac.Site (latitude=latitude,
+                    longitude='0', elevation=0, tzoffset=0)),
+                precision_run)
+
+# Picking the bodies of a large catalog that a site can see, for one year.
+catalog_size = 5000
+
+def catalog_setup (stage):
+    def setup ():
+        fresh_start ()
+        # Evenly spread over the sky and from magnitude -1 to 9.
+        bodies = []
+        for i in range (catalog_size):
+            body = ephem.FixedBody ()
+            body.name = "S%d" % (i,)
+            body._ra = ephem.hours (2 * math.pi * ((i * 0.618034) % 1))
+            body._dec = ephem.degrees (math.asin (2 * ((i * 0.414214) % 1) - 1))
+            body.mag = -1 + 10 * ((i * 0.732051) % 1)
+            bodies.append (body)
+        site = astroalmanac.Site ()
+        first, last = astroalmanac.chart_dates ('2024', '2025', site.tzoffset)
+        index = None
+        if stage == "visible":
+            index = astroalmanac.CatalogIndex (bodies, first, last)
+        return (bodies, astroalmanac.site_observer (site), first, last, index)
+    return setup
+
+def catalog_run (stage):
+    def run (state):
+        bodies, where, first, last, index = state
+        if stage == "index":
+            astroalmanac.CatalogIndex (bodies, first, last)
+        else:
+            index.visible (where, first, int (last - first + 0.5),
+                    max_magnitude=6)
+    return run
+
+for stage in ("index", "visible"):
+    benchmark ("catalog.%s" % (stage,), catalog_setup (stage), catalog_run (stage))
+
+# Rendering stages of a one year chart, each on a fresh figure.
+render_data = []
+
+def render_setup (stage):
+    def setup ():
+        if not render_data:
+            render_data.append (astroalmanac.compute_almanac (
+                    astroalmanac.Site (), '2024', '2025'))
+        data = render_data[0]
+        fig, axes, start_hour, end_hour = astroalmanac.chart_axes (data)
+        days = range (data["days_in_chart"])
+        if stage in ("savefig_pdf", "savefig_png"):
+            astroalmanac.draw_date_lines (start_hour, end_hour, days, axes,
+                    data["times"], data["start_date"])
+            astroalmanac.draw_time_lines (start_hour, end_hour, days, axes,
+                    data["times"])
+            astroalmanac.draw_events (axes, data, astroalmanac.chart_plots)
+        return (fig, axes, start_hour, end_hour, days, data)
+    return setup
+
+def render_run (stage):
+    def run (state):
+        fig, axes, start_hour, end_hour, days, data = state
+        if stage == "draw_time_lines":
+            astroalmanac.draw_time_lines (start_hour, end_hour, days, axes,
+                    data["times"])
+        elif stage == "draw_date_lines":
+            astroalmanac.draw_date_lines (start_hour, end_hour, days, axes,
+                    data["times"], data["start_date"])
+        elif stage == "plot_object_event":
+            astroalmanac.draw_events (axes, data, astroalmanac.chart_plots)
+        elif stage == "savefig_pdf":
+            fig.savefig (io.BytesIO (), format="pdf")
+        elif stage == "savefig_png":
+            fig.savefig (io.BytesIO (), format="png")
+        plt.close (fig)
+    return run
+
+for stage in ("draw_time_lines", "draw_date_lines", "plot_object_event",
+        "savefig_pdf", "savefig_png"):
+    benchmark ("render.%s" % (stage,), render_setup (stage), render_run (stage))
+
+# The dot grids drawn as an image, and whole charts saved as PDF with the
+# grid drawn as dots, as an image (--raster-grid) drawn afresh, and as the
+# image kept in astroalmanac.layer_cache by an earlier render.
+def layers_setup (stage):
+    def setup ():
+        if not render_data:
+            render_data.append (astroalmanac.compute_almanac (
+                    astroalmanac.Site (), '2024', '2025'))
+        data = render_data[0]
+        astroalmanac.layer_cache.clear ()
+        if stage == "almanac_pdf_raster_grid_cached":
+            astroalmanac.grid_dpi = 200
+            try:
+                astroalmanac.render_almanac (data, io.BytesIO (),
+                        format="pdf")
+            finally:
+                astroalmanac.grid_dpi = None
+        fig, axes, start_hour, end_hour = astroalmanac.chart_axes (data)
+        return (fig, axes, start_hour, end_hour, data)
+    return setup
+
+def layers_run (stage):
+    def run (state):
+        fig, axes, start_hour, end_hour, data = state
+        if stage != "almanac_pdf":
+            astroalmanac.grid_dpi = 200
+        try:
+            if stage == "grid_image":
+                astroalmanac.grid_image (axes, start_hour, end_hour,
+                        range (data["days_in_chart"]), data["times"])
+            else:
+                astroalmanac.render_almanac (data, io.BytesIO (),
+                        format="pdf")
+        finally:
+            astroalmanac.grid_dpi = None
+        plt.close (fig)
+    return run
+
+for stage in ("grid_image", "almanac_pdf", "almanac_pdf_raster_grid",
+        "almanac_pdf_raster_grid_cached"):
+    benchmark ("render.%s" % (stage,), layers_setup (stage), layers_run (stage))
+
+# The same one year chart as four quarterly pages of one PDF.
+def pages_setup ():
+    if not render_data:
+        render_data.append (astroalmanac.compute_almanac (
+                astroalmanac.Site (), '2024', '2025'))
+    data = render_data[0]
+    return (data, astroalmanac.page_dates (data["start_date"],
+            data["end_date"], "quarters", data["site"].tzoffset))
+
+def pages_run (state):
+    data, pages = state
+    astroalmanac.render_pages (data, pages, io.BytesIO ())
+
+benchmark ("render.pages_quarters", pages_setup, pages_run)
+
+def environment ():
+    '''What the results were measured on.'''
+    try:
+        commit = subprocess.run (["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname (os.path.abspath (__file__)),
+                capture_output=True, text=True).stdout.strip ()
+    except OSError:
+        commit = ""
+    return dict (commit=commit, python=platform.python_version (),
+            machine=platform.machine (), processor=platform.processor (),
+            cpus=os.cpu_count (), ephem=ephem.__version__,
+            numpy=numpy.__version__, matplotlib=matplotlib.__version__,
+            date=time.strftime ("%Y-%m-%dT%H:%M:%S"))
+
+def run_benchmarks (names, repeat):
+    '''Time each benchmark in names. Returns name -> result dict.
+    A run that returns a number (seconds from exact, for the precision
+    benchmarks) has the largest of them kept as deviation.'''
+    results = {}
+    for name in names:
+        setup, run = benchmarks[name]
+        samples = []
+        deviation = None
+        error = None
+        for _ in range (repeat):
+            state = setup ()
+            start = time.perf_counter ()
+            try:
+                value = run (state)
+            except Exception as e:
+                error = "%s: %s" % (type (e).__name__, e)
+                break
+            samples.append (time.perf_counter () - start)
+            if value != None:
+                deviation = max (value, deviation or 0.0)
+        if error != None:
+            results[name] = dict (error=error)
+            print ("%-40s FAILED %s" % (name, error))
+            continue
+        results[name] = dict (min=min (samples),
+                median=statistics.median (samples), repeat=repeat)
+        if deviation != None:
+            results[name]["deviation"] = deviation
+        print ("%-40s %9.4f s  (median %.4f s)%s" % (name, min (samples),
+                statistics.median (samples), "" if deviation == None
+                else "  %.2f s from exact" % (deviation,)))
+    return results
+
+deviation_slack = 0.5    # seconds a precision benchmark may drift
+
+def compare (results, baseline, threshold):
+    '''
+    Print each benchmark's time as a ratio of baseline's.
+    Returns the names that are slower than threshold times baseline, newly
+    failing, or more than deviation_slack seconds further from exact.
+    '''
+    slower = []
+    print ()
+    print ("%-40s %10s %10s %7s" % ("benchmark", "baseline", "now", "ratio"))
+    for name, result in results.items ():
+        old = baseline.get (name)
+        if old == None or "min" not in old:
+            print ("%-40s %10s %10s" % (name, "-",
+                    "failed" if "error" in result else "%.4f" % result["min"]))
+            continue
+        if "error" in result:
+            print ("%-40s %10.4f %10s" % (name, old["min"], "failed"))
+            slower.append (name)
+            continue
+        ratio = result["min"] / old["min"]
+        flag = "  SLOWER" if ratio > threshold else ""
+        if (result.get ("deviation", 0.0)
+                > old.get ("deviation", 0.0) + deviation_slack):
+            flag += "  LESS PRECISE (%.2f s from exact, was %.2f s)" % (
+                    result["deviation"], old.get ("deviation", 0.0))
+        print ("%-40s %10.4f %10.4f %7.2f%s" % (name, old["min"],
+                result["min"], ratio, flag))
+        if flag:
+            slower.append (name)
+    return slower
+
+def main ():
+    parser = argparse.ArgumentParser (description='Benchmark astroalmanac')
+    parser.add_argument ('--filter', '-k', type=str, default='',
+            help='only run benchmarks whose name contains this')
+    parser.add_argument ('--repeat', '-r', type=int, default=3,
+            help='times to run each benchmark. Default: %(default)s')
+    parser.add_argument ('--save', type=str, default=None, metavar='FILE',
+            help='write the results to FILE as JSON')
+    parser.add_argument ('--compare', type=str, default=None, metavar='FILE',
+            help='compare the results with those saved in FILE')
+    parser.add_argument ('--threshold', type=float, default=1.25,
+            help='with --compare, fail if a benchmark takes more than this many times as long as before. Default: %(default)s')
+    parser.add_argument ('--list', action='store_true',
+            help='list the benchmarks and exit')
+    args = parser.parse_args ()
+    names = [name for name in benchmarks if args.filter in name]
+    if args.list:
+        print ("\n".join (names))
+        return 0
+    results = run_benchmarks (names, args.repeat)
+    if args.save != None:
+        with open (args.save, "w") as f:
+            json.dump (dict (environment=environment (), results=results), f,
+                    indent=1)
+    if args.compare != None:
+        with open (args.compare) as f:
+            baseline = json.load (f)["results"]
+        if compare (results, baseline, args.threshold):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit (main ())